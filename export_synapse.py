@@ -102,8 +102,7 @@ def synapses_to_bag(study_list, dest, protocol_types, bag_metadata=None, publish
         os.chdir('synapse-studies')
         dumpdir = os.getcwd()
 
-        for study in study_list:
-            copy_synapse_files(objectstore, study)
+        copy_synapse_files(objectstore, study_list)
 
         # Now write out the CSV file will the list of studies...
         with open('studies.csv', 'w', newline='') as csvfile:
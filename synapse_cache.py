@@ -0,0 +1,435 @@
+import io
+import os
+import copy
+import json
+import base64
+import shutil
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from deriva.core.hatrac_store import HatracHashMismatch
+
+# Default location and size limit for the local copies of hatrac objects.
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'synapse_datasets')
+cache_size = 20 * 2 ** 30
+
+# Number of computed results kept in memory.
+result_entries = 16
+
+
+def versioned(url):
+    """
+    Hatrac URLs that end in a :version suffix refer to an object whose content can never change.
+    """
+    return ':' in os.path.basename(url)
+
+
+class ObjectCache(object):
+    """
+    An on-disk cache of hatrac objects.  Entries are keyed by the MD5 of the object when we know it, or by the
+    versioned URL otherwise, so only immutable content is ever cached.  When the total size goes over the limit the
+    least recently used entries are removed.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = os.path.join(path or cache_dir, 'objects')
+        self.max_bytes = cache_size if max_bytes is None else max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.path, mode=0o777, exist_ok=True)
+
+    def key(self, url, md5=None):
+        if md5:
+            return 'md5-' + md5.replace('/', '_').replace('+', '-')
+        if versioned(url):
+            return 'url-' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return None
+
+    def lookup(self, url, md5=None):
+        """
+        Return the name of the local copy of an object, or None if it is not in the cache.
+        """
+        key = self.key(url, md5)
+        if key is None:
+            return None
+        fname = os.path.join(self.path, key)
+        try:
+            # Mark the entry as recently used.
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        return fname
+
+    def get_obj(self, objectstore, url, destfilename=None, md5=None):
+        """
+        Get a local copy of a hatrac object, downloading it only if it is not already in the cache.
+        :param objectstore: HatracStore to get the object from
+        :param url: path of the object
+        :param destfilename: where to put the object if it can't be cached because it is not versioned.
+        :param md5: MD5 of the object if it is known.
+        :return: name of a local file with the content of the object.  Cached files must not be modified.
+        """
+        fname = self.lookup(url, md5)
+        if fname:
+            return fname
+
+        key = self.key(url, md5)
+        if key is None:
+            objectstore.get_obj(url, destfilename=destfilename)
+            return destfilename
+
+        # Download next to the entry and then rename it, so other readers never see a partial file.
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, prefix='.download-')
+        os.close(fd)
+        try:
+            # get_obj checks the hash hatrac sends with the object, but the entry is keyed by the MD5 we were given.
+            objectstore.get_obj(url, destfilename=tmpfile)
+            if md5:
+                digest = hashlib.md5()
+                with open(tmpfile, 'rb') as fo:
+                    for chunk in iter(lambda: fo.read(2 ** 20), b''):
+                        digest.update(chunk)
+                check_md5(digest, md5, url)
+            fname = os.path.join(self.path, key)
+            os.replace(tmpfile, fname)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        self.evict(keep=fname)
+        return fname
+
+    def open_obj(self, objectstore, url, md5=None):
+        """
+        Open a hatrac object for reading as a stream.  Cached objects are read from the local copy.  Otherwise the
+        object is streamed from the server, and if it can be cached, what is read is also saved to the cache.
+        :param objectstore: HatracStore to get the object from
+        :param url: path of the object
+        :param md5: MD5 of the object if it is known.
+        :return: a binary file object.
+        """
+        fname = self.lookup(url, md5)
+        if fname:
+            return open(fname, 'rb')
+        source = stream_obj(objectstore, url)
+        key = self.key(url, md5)
+        if key is None:
+            return io.BufferedReader(source)
+        return io.BufferedReader(CachingStream(self, source, os.path.join(self.path, key),
+                                               md5=md5 or source.headers.get('Content-MD5'), url=url))
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is under its size limit.
+        """
+        with self.lock:
+            entries = [e for e in os.scandir(self.path) if e.is_file() and not e.name.startswith('.')]
+            total = sum(e.stat().st_size for e in entries)
+            for e in sorted(entries, key=lambda e: e.stat().st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if e.path == keep:
+                    continue
+                total -= e.stat().st_size
+                try:
+                    os.remove(e.path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            for e in os.scandir(self.path):
+                if e.is_file():
+                    os.remove(e.path)
+
+
+def check_md5(digest, expected, url):
+    """
+    Raise HatracHashMismatch if the MD5 of what was read from an object is not the one that was expected.
+    :param digest: hashlib MD5 of the content
+    :param expected: base64 MD5, as in the Content-MD5 header and the MD5 column of the catalog, or None to not check.
+    :param url: path of the object for the error message
+    """
+    actual = base64.b64encode(digest.digest()).decode('ascii')
+    if expected and actual != expected:
+        raise HatracHashMismatch('Content-MD5 of {0} is {1} but {2} was expected'.format(url, actual, expected))
+
+
+class ResponseStream(io.RawIOBase):
+    """
+    A binary stream over the content of a response from HatracStore.get.
+    """
+
+    def __init__(self, response, chunk_size=2 ** 20):
+        self.response = response
+        self.headers = response.headers
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.response.close()
+        super().close()
+
+
+def stream_obj(objectstore, url):
+    """
+    Open a hatrac object as a stream from the server rather than downloading it first.
+    :return: a ResponseStream, whose headers are those of the response.
+    """
+    r = objectstore.get(url, stream=True)
+    r.raise_for_status()
+    return ResponseStream(r)
+
+
+class CachingStream(io.RawIOBase):
+    """
+    A stream that saves what is read from it into the object cache.  The entry is only added once the whole object
+    has been read and its MD5 checked, so a stream that is closed part way through leaves nothing behind.
+    """
+
+    def __init__(self, cache, source, fname, md5=None, url=None):
+        """
+        :param cache: the ObjectCache
+        :param source: binary stream of the object
+        :param fname: name of the cache entry
+        :param md5: base64 MD5 the content must have to be cached, or None to cache it without checking.
+        :param url: path of the object for error messages
+        """
+        self.cache = cache
+        self.source = source
+        self.fname = fname
+        self.md5 = md5
+        self.url = url or fname
+        self.digest = hashlib.md5()
+        fd, self.tmpfile = tempfile.mkstemp(dir=cache.path, prefix='.download-')
+        self.copy = os.fdopen(fd, 'wb')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.source.readinto(b)
+        if n:
+            if self.copy is not None:
+                self.copy.write(memoryview(b)[:n])
+                self.digest.update(memoryview(b)[:n])
+        elif self.copy is not None:
+            # End of the object, so the copy is complete.
+            self.copy.close()
+            self.copy = None
+            try:
+                check_md5(self.digest, self.md5, self.url)
+            except HatracHashMismatch:
+                os.remove(self.tmpfile)
+                raise
+            os.replace(self.tmpfile, self.fname)
+            self.cache.evict(keep=self.fname)
+        return n
+
+    def close(self):
+        if self.copy is not None:
+            self.copy.close()
+            self.copy = None
+            os.remove(self.tmpfile)
+        self.source.close()
+        super().close()
+
+
+object_cache = None
+
+
+def get_object_cache():
+    """
+    Return the cache used for hatrac objects, creating it in the default location the first time.  Set
+    synapse_cache.object_cache to an ObjectCache to use a different location or size.
+    """
+    global object_cache
+    if object_cache is None:
+        object_cache = ObjectCache()
+    return object_cache
+
+
+class QueryCache(object):
+    """
+    A persistent cache of catalog query results.  Results from a catalog snapshot can never change, so they are
+    keyed by the snapshot time and the path URI of the query and kept both in memory and on disk.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.join(path or cache_dir, 'queries')
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def fname(self, snaptime, uri):
+        return os.path.join(self.path, snaptime, hashlib.sha256(uri.encode('utf-8')).hexdigest())
+
+    def lookup(self, snaptime, uri):
+        """
+        Return the cached result of a query, or None if the query has not been run against this snapshot.
+        """
+        with self.lock:
+            result = self.memory.get((snaptime, uri))
+        if result is None:
+            try:
+                with open(self.fname(snaptime, uri), 'rb') as fo:
+                    result = pickle.load(fo)
+            except FileNotFoundError:
+                return None
+            with self.lock:
+                self.memory[(snaptime, uri)] = result
+        return copy.deepcopy(result)
+
+    def put(self, snaptime, uri, result):
+        fname = self.fname(snaptime, uri)
+        os.makedirs(os.path.dirname(fname), mode=0o777, exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.query-')
+        with os.fdopen(fd, 'wb') as fo:
+            pickle.dump(result, fo)
+        os.replace(tmpfile, fname)
+        with self.lock:
+            self.memory[(snaptime, uri)] = result
+
+    def get(self, snaptime, uri, query):
+        """
+        Return the result of a query, only running it if it has not already been run against this snapshot.
+        :param snaptime: the catalog snapshot the query is pinned to.  If None, the query is always run.
+        :param uri: path URI for the query, or another string that uniquely identifies it in the snapshot.
+        :param query: function that runs the query and returns a result that can be pickled.
+        :return: a copy of the result, so callers are free to modify it.
+        """
+        if not snaptime:
+            return query()
+
+        result = self.lookup(snaptime, uri)
+        if result is None:
+            result = query()
+            self.put(snaptime, uri, result)
+            result = copy.deepcopy(result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+query_cache = None
+
+
+def get_query_cache():
+    """
+    Return the cache used for catalog queries, creating it in the default location the first time.
+    """
+    global query_cache
+    if query_cache is None:
+        query_cache = QueryCache()
+    return query_cache
+
+
+def result_key(*inputs):
+    """
+    Compute a key for a result from everything that it depends on.
+    :param inputs: values that can be converted to JSON, such as the provenance of the data and the parameters.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    A cache of computed results, such as the binned synapses of a studyset, keyed by result_key of their inputs.  The
+    most recently used results are kept in memory, and if a path is given they are also saved on disk, so they can be
+    reused in a later session.
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        """
+        :param path: directory for the on-disk store, or None to only keep results in memory.
+        :param max_entries: number of results kept in memory.
+        """
+        self.path = os.path.join(path, 'results') if path else None
+        self.max_entries = result_entries if max_entries is None else max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fname(self, key):
+        return os.path.join(self.path, key)
+
+    def remember(self, key, result):
+        with self.lock:
+            self.memory[key] = result
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        """
+        Return a cached result, or None if it has not been computed.
+        """
+        with self.lock:
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory.move_to_end(key)
+        if result is None and self.path:
+            try:
+                with open(self.fname(key), 'rb') as fo:
+                    result = pickle.load(fo)
+            except FileNotFoundError:
+                return None
+            self.remember(key, result)
+        return result
+
+    def put(self, key, result):
+        if self.path:
+            os.makedirs(self.path, mode=0o777, exist_ok=True)
+            fd, tmpfile = tempfile.mkstemp(dir=self.path, prefix='.result-')
+            with os.fdopen(fd, 'wb') as fo:
+                pickle.dump(result, fo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, self.fname(key))
+        self.remember(key, result)
+
+    def get(self, key, compute):
+        """
+        Return a result, only computing it if it is not already in the cache.
+        :param key: key of the result from result_key
+        :param compute: function that computes the result, which must be able to be pickled.
+        :return: a copy of the result, so callers are free to modify it.
+        """
+        result = self.lookup(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return copy.deepcopy(result)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.path:
+                shutil.rmtree(self.path, ignore_errors=True)
+
+
+result_cache = None
+
+
+def get_result_cache():
+    """
+    Return the cache used for computed results, creating one that is only kept in memory the first time.  Set
+    synapse_cache.result_cache to ResultCache(synapse_cache.cache_dir) to also keep the results on disk.
+    """
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache()
+    return result_cache
@@ -0,0 +1,70 @@
+import io
+import shutil
+import numpy as np
+import pandas as pd
+
+# Columns of the synapse CSV files that we use: position, and the core and hollow intensities.
+synapse_columns = ['Z', 'Y', 'X', 'raw core', 'raw hollow']
+
+# The row after the header in files saved by synspy holds the segmentation parameters rather than a synapse.
+metadata_row = b'saved,parameters'
+
+
+class SynapseStream(io.RawIOBase):
+    """
+    Binary stream over a synapse CSV file that leaves out the metadata row, and can copy what is read into another
+    file at the same time.
+    """
+
+    def __init__(self, source, tee=None):
+        """
+        :param source: binary file object with the CSV, i.e. an open file or the body of an HTTP response.
+        :param tee: binary file object that the cleaned CSV is written to as it is read, or None.
+        """
+        self.source = source if hasattr(source, 'peek') else io.BufferedReader(source)
+        header = self.source.readline()
+        row = self.source.readline()
+        self.pending = header if metadata_row in row else header + row
+        self.tee = tee
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.pending:
+            data, self.pending = self.pending[:len(b)], self.pending[len(b):]
+        else:
+            data = self.source.read(len(b))
+        b[:len(data)] = data
+        if self.tee is not None and data:
+            self.tee.write(data)
+        return len(data)
+
+    def close(self):
+        self.source.close()
+        super().close()
+
+
+def read_synapses(source, columns=synapse_columns, tee=None):
+    """
+    Parse a synapse CSV file as it is read, without the metadata row.
+    :param source: binary file object with the CSV
+    :param columns: list of columns to load as floats, or None to load all of them.
+    :param tee: binary file object that the cleaned CSV is written to at the same time, or None.
+    :return: DataFrame with the selected columns.
+    """
+    with io.BufferedReader(SynapseStream(source, tee)) as stream:
+        if columns is None:
+            return pd.read_csv(stream)
+        data = pd.read_csv(stream, usecols=columns, dtype={c: np.float64 for c in columns})
+    return data[columns]
+
+
+def copy_synapses(source, dest):
+    """
+    Copy a synapse CSV file without the metadata row.
+    :param source: binary file object with the CSV
+    :param dest: binary file object to write to
+    """
+    with SynapseStream(source) as stream:
+        shutil.copyfileobj(stream, dest, 2 ** 20)
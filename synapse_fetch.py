@@ -0,0 +1,120 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import synapse_cache
+
+# Defaults for the number of downloads in flight and how many times to try each one.
+max_workers = 8
+max_attempts = 3
+retry_delay = 1.0
+
+
+def with_retries(func, item, attempts=max_attempts, fatal=(), label=None):
+    """
+    Call func(item), trying again with an increasing delay if it raises an exception.
+    :param func: function to call
+    :param item: argument to the function
+    :param attempts: maximum number of times to call the function
+    :param fatal: exception types that should not be retried, i.e. an object that does not exist.
+    :param label: name of the item used in messages
+    :return: result of the function
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(item)
+        except fatal:
+            raise
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            print('Retrying {0} after error ({1}/{2}): {3}'.format(label or item, attempt, attempts, e))
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+
+
+def concurrent_map(func, items, workers=max_workers, attempts=max_attempts, fatal=(), label=None, progress=True):
+    """
+    Apply func to each item using a pool of threads, with at most workers calls in flight at once.  Results are
+    generated in the same order as the items, and only a bounded number are held waiting to be consumed, so
+    the caller can work on one result while the following ones are being retrieved.
+    :param func: function to call for each item
+    :param items: list of items
+    :param workers: number of calls that may run at the same time
+    :param attempts: number of times to try each call
+    :param fatal: exception types that are not retried
+    :param label: function that returns a name for an item to use in progress messages
+    :param progress: print a message as each item finishes
+    :return: generator of (item, result, error) where error is the exception if the call failed, otherwise None
+    """
+    items = list(items)
+    label = label or str
+    lock = threading.Lock()
+    count = [0]
+
+    def task(item):
+        try:
+            result = with_retries(func, item, attempts=attempts, fatal=fatal, label=label(item))
+            status = 'Retrieved'
+            return result
+        except Exception:
+            status = 'Failed'
+            raise
+        finally:
+            if progress:
+                with lock:
+                    count[0] += 1
+                    print('{0} {1} [{2}/{3}]'.format(status, label(item), count[0], len(items)))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        it = iter(items)
+        for item in it:
+            pending.append((item, pool.submit(task, item)))
+            if len(pending) >= workers:
+                break
+        while pending:
+            item, future = pending.popleft()
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            # Keep the pool full as results are consumed.
+            for next_item in it:
+                pending.append((next_item, pool.submit(task, next_item)))
+                break
+            yield item, result, error
+
+
+def concurrent_list(func, items, workers=max_workers, attempts=max_attempts, fatal=(), label=None, progress=True):
+    """
+    Like concurrent_map, but wait for all of the calls and return a list of results.  If any call failed, the
+    first error is raised.
+    """
+    results = []
+    for item, result, error in concurrent_map(func, items, workers=workers, attempts=attempts, fatal=fatal,
+                                              label=label, progress=progress):
+        if error is not None:
+            raise error
+        results.append(result)
+    return results
+
+
+def download_objects(objectstore, objects, workers=max_workers, attempts=max_attempts, progress=True, cache=True):
+    """
+    Download a set of objects from hatrac at the same time.
+    :param objectstore: HatracStore to get the objects from
+    :param objects: list of (URL, local file name) pairs
+    :param workers: number of downloads in flight at once
+    :param attempts: number of times to try each download
+    :param progress: print a message as each object is retrieved.
+    :param cache: If true, versioned objects are read from and saved to the local object cache.
+    :return: list of local file names, which will be in the cache rather than the requested file for cached objects.
+    """
+    def get(obj):
+        if cache:
+            return synapse_cache.get_object_cache().get_obj(objectstore, obj[0], destfilename=obj[1])
+        objectstore.get_obj(obj[0], destfilename=obj[1])
+        return obj[1]
+
+    return concurrent_list(get, objects, workers=workers, attempts=attempts, label=lambda obj: obj[0],
+                           progress=progress)
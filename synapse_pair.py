@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Column of the intensity used for the ratio constraints in the (z, y, x, core, hollow) synapse arrays.
+core_column = 3
+
+
+def pairing_space(pts, ratio=None):
+    """
+    Get the coordinates that synapses are matched in.
+    :param pts: array of synapses with columns z, y, x, core, hollow
+    :param ratio: If given, the core intensity is added as a fourth dimension, scaled by this weight, so that
+                  synapses with similar intensities are closer together.
+    :return: array with a row for each synapse
+    """
+    if ratio is None:
+        return np.ascontiguousarray(pts[:, 0:3], dtype=np.float64)
+    return np.column_stack([pts[:, 0:3], pts[:, core_column] * ratio]).astype(np.float64)
+
+
+def intensity_ratio(c1, c2):
+    """
+    Ratio of the brighter to the dimmer of two core intensities.
+    """
+    c1 = np.asarray(c1, dtype=np.float64)
+    c2 = np.asarray(c2, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.maximum(c1, c2) / np.minimum(c1, c2)
+
+
+def nearest(tree, pts, radius, workers=-1):
+    """
+    Find the nearest neighbour in a tree of each point, within radius.
+    :return: (index, distance) with index -1 where there is no neighbour within the radius.
+    """
+    distance, idx = tree.query(pts, k=1, distance_upper_bound=radius, workers=workers)
+    missing = ~np.isfinite(distance)
+    idx = np.where(missing, -1, idx)
+    return idx, distance
+
+
+def pair_synapses(s1, s2, radius, ratio=None, maxratio=None, workers=-1):
+    """
+    Pair two point clouds of synapses.  Two synapses are paired if each is the other's nearest neighbour and they
+    are within radius of each other.  Since a mutual nearest neighbour pair does not depend on the radius, the
+    pairs for any smaller radius are the ones whose distance is within it.
+    :param s1: array of before synapses with columns z, y, x, core, hollow
+    :param s2: array of after synapses
+    :param radius: largest distance between paired synapses
+    :param ratio: weight of the core intensity as a fourth matching dimension, or None to match on position only.
+    :param maxratio: If given, pairs whose core intensities differ by more than this ratio are left unpaired.
+    :param workers: number of threads used for the tree queries, -1 for all of the cores.
+    :return: (s1_to_s2, s2_to_s1, distance) where s1_to_s2 is the index of the partner of each before synapse or -1,
+             s2_to_s1 is the same for the after synapses, and distance is the match distance of each before synapse.
+    """
+    v1, v2 = pairing_space(s1, ratio), pairing_space(s2, ratio)
+    s1_to_s2 = np.full(len(v1), -1, dtype=np.int32)
+    s2_to_s1 = np.full(len(v2), -1, dtype=np.int32)
+    distance = np.full(len(v1), np.inf)
+    if len(v1) == 0 or len(v2) == 0:
+        return s1_to_s2, s2_to_s1, distance
+
+    nearest2, dist1 = nearest(cKDTree(v2), v1, radius, workers)
+    nearest1, _ = nearest(cKDTree(v1), v2, radius, workers)
+
+    # Keep the pairs where the nearest neighbour relation goes both ways.
+    idx1 = np.nonzero(nearest2 >= 0)[0]
+    idx1 = idx1[nearest1[nearest2[idx1]] == idx1]
+    idx2 = nearest2[idx1]
+
+    if maxratio is not None:
+        keep = intensity_ratio(s1[idx1, core_column], s2[idx2, core_column]) <= maxratio
+        idx1, idx2 = idx1[keep], idx2[keep]
+
+    s1_to_s2[idx1] = idx2
+    s2_to_s1[idx2] = idx1
+    distance[idx1] = dist1[idx1]
+    return s1_to_s2, s2_to_s1, distance
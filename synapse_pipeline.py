@@ -0,0 +1,89 @@
+import queue
+import threading
+
+# Default number of items that can wait between two stages.
+queue_size = 2
+
+# Marks the end of the items on a queue.
+_done = object()
+
+
+class Stage(object):
+    """
+    A step in a pipeline: a function that is applied to the result of the previous stage by a number of threads.
+    """
+
+    def __init__(self, name, func, workers=1):
+        """
+        :param name: name of the stage
+        :param func: function that takes the result of the previous stage, or the item for the first stage.
+        :param workers: number of threads running the function
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+def run_pipeline(items, stages, queue_size=queue_size):
+    """
+    Pass each item through a series of stages, with each stage working on different items at the same time.  Stages
+    are connected by bounded queues, and the number of items in the pipeline is limited, so a slow stage holds back
+    the ones before it rather than letting results pile up.  If a stage fails for an item, the later stages are
+    skipped for that item.
+    :param items: list of items
+    :param stages: list of Stage
+    :param queue_size: number of items that can wait between two stages.
+    :return: generator of (item, result, error) in the same order as items, where result is the value returned by the
+             last stage and error is the exception if a stage failed, otherwise None.
+    """
+    items = list(items)
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    # Results are put back in order at the end, so also bound the number of items that have been started but not
+    # yet consumed.
+    capacity = threading.Semaphore(sum(s.workers for s in stages) + queue_size * (len(stages) + 1))
+    running = [s.workers for s in stages]
+    lock = threading.Lock()
+
+    def feed():
+        for n, item in enumerate(items):
+            capacity.acquire()
+            queues[0].put((n, item, item, None))
+        for _ in range(stages[0].workers):
+            queues[0].put(_done)
+
+    def work(k):
+        stage = stages[k]
+        while True:
+            task = queues[k].get()
+            if task is _done:
+                break
+            n, item, value, error = task
+            if error is None:
+                try:
+                    value = stage.func(value)
+                except Exception as e:
+                    value, error = None, e
+            queues[k + 1].put((n, item, value, error))
+        # The last thread to finish a stage tells the next stage that there are no more items.
+        with lock:
+            running[k] -= 1
+            last = running[k] == 0
+        if last and k + 1 < len(stages):
+            for _ in range(stages[k + 1].workers):
+                queues[k + 1].put(_done)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for k, stage in enumerate(stages):
+        threads.extend(threading.Thread(target=work, args=(k,), name='{0}-{1}'.format(stage.name, w), daemon=True)
+                       for w in range(stage.workers))
+    for t in threads:
+        t.start()
+
+    finished = {}
+    for n in range(len(items)):
+        while n not in finished:
+            task = queues[-1].get()
+            finished[task[0]] = task
+        _, item, value, error = finished.pop(n)
+        capacity.release()
+        yield item, value, error
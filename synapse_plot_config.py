@@ -5,6 +5,7 @@ import plotly.graph_objs as go
 import random
 from collections import OrderedDict
 import numpy as np
+from synapse_plot_utils import summary_bounds
 
 
 # Generate shades of blue and orange for the plots and assign colors to the different trace types.
@@ -320,6 +321,13 @@ def plot_synapses(studylist,
     maxx, maxy, maxz, = [-float('inf')] * 3
     minx, miny, minz = [float('inf')] * 3
 
+    # Centroids are inside the bounds of their points, so the bounds of the point traces come from the study
+    # summaries.  Anything else has to be scanned.
+    summarized = [t for t in tracelist if t != 'AlignmentPts' and 'Centroid' not in t]
+    bounds = summary_bounds(studylist, summarized, radius) if summarized else None
+    if bounds:
+        (maxx, maxy, maxz), (minx, miny, minz) = bounds
+
     # We would like studies and traces to remain in user specified order....
     study_map, trace_map = [OrderedDict(), OrderedDict()]
     for s in studylist:
@@ -333,12 +341,13 @@ def plot_synapses(studylist,
         for idx, t in enumerate(tracelist):
             synapse_data = s[t][radius]['Data']
 
-            maxx = max(maxx, synapse_data['x'].max())
-            maxy = max(maxy, synapse_data['y'].max())
-            maxz = max(maxz, synapse_data['z'].max())
-            minx = min(minx, synapse_data['x'].min())
-            miny = min(miny, synapse_data['y'].min())
-            minz = min(minz, synapse_data['z'].min())
+            if not bounds or (t not in summarized and 'Centroid' not in t):
+                maxx = max(maxx, synapse_data['x'].max())
+                maxy = max(maxy, synapse_data['y'].max())
+                maxz = max(maxz, synapse_data['z'].max())
+                minx = min(minx, synapse_data['x'].min())
+                miny = min(miny, synapse_data['y'].min())
+                minz = min(minz, synapse_data['z'].min())
 
             x, y, z = list(synapse_data['x']), list(synapse_data['y']), list(synapse_data['z'])
 
@@ -1,6 +1,9 @@
+import hashlib
+import numpy as np
 import pandas as pd
 import xarray as xr
 from math import floor, ceil
+import synapse_cache
 
 synapseserver = 'synapse-dev.isrd.isi.edu'
 
@@ -12,177 +15,654 @@ pair_types = ['Before', 'After',
               'AlignedPairedBefore', 'AlignedPairedAfter',
               'AlignedUnpairedBefore', 'AlignedUnpairedAfter']
 
-def aggregate_studies(studylist):
+def summary_bounds(studylist, datatypes, radius):
+    """
+    Look up the bounds of a set of datatypes across a list of studies in the study summaries, rather than going
+    through the points.
+    :param studylist: list of studies
+    :param datatypes: list of datatypes, i.e. AlignedPairedBefore
+    :param radius: pairing radius
+    :return: ((max_x, max_y, max_z), (min_x, min_y, min_z)), or None if a study doesn't have a summary.
+    """
+    if not all('Summary' in s for s in studylist):
+        return None
+    summary = pd.concat([s['Summary'] for s in studylist], ignore_index=True)
+    rows = summary[summary['DataType'].isin(datatypes) & (summary['Radius'] == radius) & (summary['Count'] > 0)]
+    if len(rows) == 0:
+        return None
+    return tuple(rows[['MaxX', 'MaxY', 'MaxZ']].max()), tuple(rows[['MinX', 'MinY', 'MinZ']].min())
+
+
+# Datatypes that make up the aggregated synapses, and the groupings of them that aggregate_studies returns.
+aggregate_datatypes = ['UnpairedBefore', 'UnpairedAfter', 'PairedBefore', 'PairedAfter']
+aggregate_groups = ['All', 'Before', 'After', 'PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter']
+aggregate_columns = ['x', 'y', 'z', 'core']
+
+
+def aligned_points(s, datatype, r):
+    """
+    Get the aligned synapses of a study for a datatype as an array with columns x, y, z, core.
+    """
+    if 'Synapses' in s:
+        return s['Synapses'].points(datatype, r, aligned=True)
+    return s['Aligned' + datatype][r]['Data'][aggregate_columns].to_numpy()
+
+
+class SynapseSelection(object):
+    """
+    A lazy selection of the aligned synapses for some of the datatypes of a list of studies.  Nothing is copied until
+    the points are asked for, either all at once with materialize, or one study and datatype at a time with chunks.
+    """
+
+    def __init__(self, sources, r):
+        """
+        :param sources: list of (study, datatype) pairs, in the order the points should appear.
+        :param r: the pairing radius
+        """
+        self.sources = sources
+        self.r = r
+
+    def __len__(self):
+        count = 0
+        for s, datatype in self.sources:
+            if 'Synapses' in s:
+                count += len(s['Synapses'].indices(datatype, self.r)[1])
+            else:
+                count += len(s['Aligned' + datatype][self.r]['Data'])
+        return count
+
+    def chunks(self):
+        """
+        Generate the points one study and datatype at a time, as arrays with columns x, y, z, core.
+        """
+        for s, datatype in self.sources:
+            yield aligned_points(s, datatype, self.r)[:, 0:4]
+
+    def materialize(self):
+        """
+        Get all of the points as a single DataFrame with columns x, y, z, core.
+        """
+        points = list(self.chunks())
+        return pd.DataFrame(np.concatenate(points) if points else np.zeros((0, 4)), columns=aggregate_columns)
+
+    def bounds(self):
+        """
+        Find the bounds of the points a chunk at a time.
+        :return: ((max_x, max_y, max_z), (min_x, min_y, min_z))
+        """
+        smax, smin = np.full(3, -np.inf), np.full(3, np.inf)
+        for pts in self.chunks():
+            if len(pts):
+                smax, smin = np.maximum(smax, pts[:, 0:3].max(axis=0)), np.minimum(smin, pts[:, 0:3].min(axis=0))
+        return tuple(float(v) for v in smax), tuple(float(v) for v in smin)
+
+
+def aggregate_views(studylist, r):
+    """
+    Group the synapses in a list of studies the same way as aggregate_studies, but as lazy selections over the arrays
+    that the studies already hold.
+    :param studylist: list of studies
+    :param r: the pairing radius
+    :return: dictionary of study type, including the pseudo type all, to a dictionary of SynapseSelection for All,
+             Before, After, PairedBefore, PairedAfter, UnpairedBefore and UnpairedAfter.
+    """
+    types = list(dict.fromkeys(s['Type'] for s in studylist)) + ['all']
+    sources = {t: {g: [] for g in aggregate_groups} for t in types}
+    for s in studylist:
+        for i in aggregate_datatypes:
+            for t in [s['Type'], 'all']:
+                for g in ['All', 'Before' if 'Before' in i else 'After', i]:
+                    sources[t][g].append((s, i))
+    return {t: {g: SynapseSelection(v, r) for g, v in groups.items()} for t, groups in sources.items()}
+
+
+def synapse_table(studylist, r):
+    """
+    Build a single table with the aligned synapses of every datatype in every study.
+    :param studylist: list of studies
+    :param r: the pairing radius
+    :return: DataFrame with columns x, y, z, core and categorical Study, Type, DataType and Timepoint columns.
+    """
+    studies = [s['Study'] for s in studylist]
+    types = list(dict.fromkeys(s['Type'] for s in studylist))
+    points, lengths = [], []
+    for s in studylist:
+        for i in aggregate_datatypes:
+            pts = aligned_points(s, i, r)
+            points.append(pts[:, 0:4])
+            lengths.append(len(pts))
+
+    table = pd.DataFrame(np.concatenate(points) if points else np.zeros((0, 4)), columns=aggregate_columns)
+    lengths = np.array(lengths, dtype=np.int64).reshape((-1, len(aggregate_datatypes)))
+    study_codes = np.repeat(np.arange(len(studylist)), lengths.sum(axis=1))
+    datatype_codes = np.repeat(np.tile(np.arange(len(aggregate_datatypes)), len(studylist)), lengths.ravel())
+    type_codes = np.array([types.index(s['Type']) for s in studylist], dtype=np.int64)[study_codes]
+    table['Study'] = pd.Categorical.from_codes(study_codes, categories=studies)
+    table['Type'] = pd.Categorical.from_codes(type_codes, categories=types)
+    table['DataType'] = pd.Categorical.from_codes(datatype_codes, categories=aggregate_datatypes)
+    table['Timepoint'] = pd.Categorical.from_codes(np.where(datatype_codes % 2 == 0, 0, 1),
+                                                   categories=['Before', 'After'])
+    return table
+
+
+def aggregate_studies(studylist, lazy=False):
     """
     Go through the list of studies and agregate all of the synapses into a single list for each study type.
     :param studylist:
+    :param lazy: If true, return SynapseSelection views over the study arrays rather than DataFrames.
     :return: A dictionary for all, learners, nonlearners, and each control type, that aggregates
             the synapses by the all, before and after and paired.  We only use the before paired.
     """
     r = min(studylist[0]['AlignedUnpairedBefore'])
-
-    study_types = {s['Type'] for s in studylist}
-    # Add a pseudo type which is for all studies.
-    study_types.add('all')
-
-    # Initialize resulting synapse dictionary so we have an entry for each study type.
-    synapses = {t: {'All': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'Before': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'After': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'PairedBefore': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'PairedAfter': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'UnpairedBefore': pd.DataFrame(columns=['x', 'y', 'z']),
-                    'UnpairedAfter': pd.DataFrame(columns=['x', 'y', 'z'])}
-                for t in study_types
-                }
-    max_x, max_y, max_z = -float('inf'), -float('inf'), -float('inf')
-    min_x, min_y, min_z = float('inf'), float('inf'), float('inf')
-    for s in studylist:
-        for i in ['UnpairedBefore', 'UnpairedAfter', 'PairedBefore', 'PairedAfter']:
-            pts = s['Aligned' + i][r]['Data']
-            # Accumulate points for all studies
-            synapses['all'][i] = synapses['all'][i].append(pts, ignore_index=True, sort=False)
-            synapses['all']['All'] = synapses['all']['All'].append(pts, ignore_index=True,sort=False)
-            # Accumulate for studys by type...
-            synapses[s['Type']][i] = synapses[s['Type']][i].append(pts, ignore_index=True, sort=False)
-            synapses[s['Type']]['All'] = synapses[s['Type']]['All'].append(pts, ignore_index=True, sort=False)
-            if 'Before' in i:
-                synapses[s['Type']]['Before'] = synapses[s['Type']]['Before'].append(pts, ignore_index=True, sort=False)
-            else:
-                synapses[s['Type']]['After'] = synapses[s['Type']]['After'].append(pts, ignore_index=True, sort=False)
-            max_x, max_y, max_z = max(max_x, pts.max()['x']), max(max_y, pts.max()['y']), max(max_z, pts.max()['z'])
-            min_x, min_y, min_z = min(min_x, pts.min()['x']), min(min_y, pts.min()['y']), min(min_z, pts.min()['z'])
+    bounds = summary_bounds(studylist, ['Aligned' + i for i in aggregate_datatypes], r)
+    if lazy:
+        synapses = aggregate_views(studylist, r)
+        smax, smin = bounds if bounds else synapses['all']['All'].bounds()
+        return synapses, smax, smin
+
+    table = synapse_table(studylist, r)
+    if bounds:
+        (max_x, max_y, max_z), (min_x, min_y, min_z) = bounds
+    else:
+        max_x, max_y, max_z = table[['x', 'y', 'z']].max()
+        min_x, min_y, min_z = table[['x', 'y', 'z']].min()
+
+    # Find the rows for each grouping of each study type.  Add a pseudo type which is for all studies.
+    rows = {t: {'All': []} for t in list(table['Type'].cat.categories) + ['all']}
+    for (t, d, tp), idx in table.groupby(['Type', 'DataType', 'Timepoint'], observed=True, sort=False).indices.items():
+        for g in [t, 'all']:
+            rows[g]['All'].append(idx)
+            rows[g].setdefault(d, []).append(idx)
+            rows[g].setdefault(tp, []).append(idx)
+
+    points = table[aggregate_columns]
+    synapses = {t: {g: points.take(np.sort(np.concatenate(v[g]))).reset_index(drop=True) if v.get(g)
+                    else pd.DataFrame(columns=aggregate_columns)
+                    for g in aggregate_groups}
+                for t, v in rows.items()}
     return synapses, (max_x, max_y, max_z), (min_x, min_y, min_z)
 
 
-def bin_synapses(studylist, nbins=10):
+# Version of the binning and density code, so cached results are not reused after it has changed.
+with open(__file__, 'rb') as _fo:
+    density_version = hashlib.sha256(_fo.read()).hexdigest()
+
+
+def result_cache(cache):
+    """
+    Get the ResultCache to use for a cache argument, which is a ResultCache or True for the default one.
+    """
+    return synapse_cache.get_result_cache() if cache is True else cache
+
+
+def study_source(s, r):
+    """
+    Describe where the synapses of a study come from, for the key of a cached result.  The pairing key in the
+    provenance covers the synapse files, the alignment and the pairing parameters.  Studies without one, i.e. because
+    their files are not versioned, are described by a hash of their aligned synapses instead.
+    """
+    provenence = s.get('Provenence', {})
+    source = {'Study': s.get('Study'), 'Type': s.get('Type'), 'StudyID': s.get('StudyID'), 'Provenence': provenence}
+    if not provenence.get('PairingKey'):
+        digest = hashlib.sha256()
+        for datatype in aggregate_datatypes:
+            digest.update(np.ascontiguousarray(aligned_points(s, datatype, r)[:, 0:4]).tobytes())
+        source['Synapses'] = digest.hexdigest()
+    return source
+
+
+def studyset_key(studylist, *parameters):
+    """
+    Compute the key of a result computed from the synapses of a list of studies.
+    :param studylist: list of studies
+    :param parameters: the name of the function and the parameters that the result depends on.
+    """
+    # The synapses are taken at the smallest radius in the studies, which changes if the studyset is filtered by
+    # radius even though the provenance doesn't.
+    r = min(studylist[0]['AlignedUnpairedBefore'])
+    return synapse_cache.result_key(density_version, float(r), [study_source(s, r) for s in studylist], *parameters)
+
+
+def bin_edges(smin, smax, binsize):
+    """
+    Compute the bin edges along each axis.  The number of bins on an axis is determined by its range and the binsize.
+    :return: list with an array of edges for x, y and z.
+    """
+    edges = []
+    for idx in range(3):
+        nbins = int(ceil((smax[idx] - smin[idx]) / binsize))
+        edges.append(np.array([smin[idx] + i * binsize for i in range(nbins + 1)]))
+    return edges
+
+
+def voxel_index(pts, edges):
+    """
+    Map points to the voxel they fall in.  Bins include their upper edge, and the first bin also includes its lower
+    edge, the same as pd.cut(..., include_lowest=True).  Points outside of the bins are dropped.
+    :param pts: array whose first three columns are x, y, z
+    :param edges: bin edges from bin_edges
+    :return: array with the flat index of the voxel of each point that is inside the bins.
+    """
+    shape = tuple(len(e) - 1 for e in edges)
+    idx = []
+    inside = np.ones(len(pts), dtype=bool)
+    for axis, e in enumerate(edges):
+        v = pts[:, axis]
+        i = np.searchsorted(e, v, side='left') - 1
+        i[v == e[0]] = 0
+        inside &= (i >= 0) & (i < shape[axis])
+        idx.append(i)
+    return np.ravel_multi_index([i[inside] for i in idx], shape)
+
+
+def aggregate_points(studylist):
+    """
+    Gather the aligned synapses of a list of studies into one array for each study type and datatype.
+    :param studylist: list of studies
+    :return: (points, smax, smin) where points is a dictionary of study type to a dictionary of datatype to an array
+             with columns x, y, z, core.
+    """
+    agg_synapses, smax, smin = aggregate_studies(studylist, lazy=True)
+    points = {t: {d: np.concatenate(list(agg_synapses[t][d].chunks()) + [np.zeros((0, 4))])
+                  for d in aggregate_datatypes}
+              for t in agg_synapses if t != 'all'}
+    return points, smax, smin
+
+
+def bin_synapses(studylist, nbins=10, sparse=False, cache=None, points=None):
     """
     Compute the density of a set of synapses. Input is a dictionary with key: All, PairedBefore, PairedAfter, ....
     :param studylist:
     :param nbins
+    :param sparse: If true, each dataset only has the voxels that have synapses in them, along a voxel dimension with
+                   x, y and z coordinates, rather than the full x, y, z grid.  Use dense_counts to expand it.
+    :param cache: a ResultCache, or True for synapse_cache.get_result_cache(), to reuse the result if the studies and
+                  parameters have not changed.  The datasets then have a SourceKey attribute, which lets the density
+                  functions cache their results too.
+    :param points: the result of aggregate_points(studylist), if it has already been computed.
     :return:
     """
+    if cache:
+        key = studyset_key(studylist, 'bin_synapses', nbins, sparse)
 
-    binned_synapses = {}
-    agg_synapses, smax, smin = aggregate_studies(studylist)
+        def compute():
+            binned_synapses = bin_synapses(studylist, nbins=nbins, sparse=sparse, points=points)
+            for ds in binned_synapses.values():
+                ds.attrs['SourceKey'] = key
+            return binned_synapses
+
+        return result_cache(cache).get(key, compute)
+
+    points, smax, smin = aggregate_points(studylist) if points is None else points
 
+    # Find the smallest range in x, y and z so we can figure out the bin sizes by dividing by the number of bins
+    binsize = min([smax[i] - smin[i] for i in range(3)]) / nbins
+    edges = bin_edges(smin, smax, binsize)
+    shape = tuple(len(e) - 1 for e in edges)
+
+    # Map the points for each type and datatype into voxels once.  The other groupings are combinations of these.
+    types = list(points)
+    voxels = {t: {d: voxel_index(points[t][d], edges) for d in aggregate_datatypes} for t in types}
+
+    if not sparse:
+        density = DensityAccumulator(smin, smax, binsize)
+        for t in types:
+            for d in aggregate_datatypes:
+                density.add_voxels(t, d, voxels[t][d])
+        return density.datasets()
+
+    voxels['all'] = {d: np.concatenate([voxels[t][d] for t in types]) for d in aggregate_datatypes}
+
+    binned_synapses = {}
     # Go through the set of synapse study types (learner, nonlearner, ....)
-    for type, synapses in agg_synapses.items():
-        # Find the smallest range in x, y and z so we can figure out the bin sizes by dividing by the number of bins
-        binsize = min([smax[i] - smin[i] for i in range(3)]) / nbins
-        ds = xr.Dataset()
-        ds.attrs['binsize'] = binsize
-        ds.attrs['min'] = smin
-        ds.attrs['max'] = smax
-        ds.attrs['type'] = 'count'
-        for k, v in enumerate(synapses):
-            bins = {}
-            for idx, c in enumerate(['x', 'y', 'z']):
-                # The number of bins will be determined by the range on the access and the binsize
-                nbins = int(ceil((smax[idx] - smin[idx]) / binsize))
-
-                # Now create an index that maps the coordinates into the bins
-                bins[c] = pd.cut(synapses[v][c],
-                                 [smin[idx] + i * binsize for i in range(nbins + 1)],
-                                 labels=[smin[idx] + i * binsize for i in range(nbins)],
-                                 include_lowest=True)
-
-            # Compute the number of synapses in the binned plane by grouping in the axis and counting them.
-            counts = synapses[v].groupby([bins['x'], bins['y'], bins['z']]).size()
-
-            # Convert the panda to a dataset, unpack the multi-index to get X,Y dimensions, and then finally,
-            # fill in the NaN that result from empty bins with 0.
-            ds[v] = xr.DataArray(counts).unstack('dim_0').fillna(0)
+    for type, v in voxels.items():
+        # Only count the voxels that have synapses in them.
+        voxel = np.unique(np.concatenate([v[d] for d in aggregate_datatypes]))
+        counts = group_counts({d: np.bincount(np.searchsorted(voxel, v[d]), minlength=len(voxel)).astype(float)
+                               for d in aggregate_datatypes})
+
+        # Keep just the voxels that have synapses, as a list of coordinates.
+        ds = count_dataset(smin, smax, binsize)
+        ix, iy, iz = np.unravel_index(voxel, shape)
+        coords = {'x': ('voxel', edges[0][ix]), 'y': ('voxel', edges[1][iy]), 'z': ('voxel', edges[2][iz])}
+        for g in aggregate_groups:
+            ds[g] = xr.DataArray(counts[g], coords=coords, dims=['voxel'])
         binned_synapses[type] = ds
     return binned_synapses
 
 
-def synapse_density(binned_synapses, axis='y', mode='density', threshold=0):
+def group_counts(counts):
     """
-    Compute the density of a set of synapses. Input is a dictionary with key: All, PairedBefore, PairedAfter, ....
-    :param studylist:
-    :param nbins:
-    :param axis:
-    :return:
+    Add the All, Before and After groupings to a dictionary of counts for each datatype.
     """
+    counts = dict(counts)
+    counts['All'] = sum(counts[d] for d in aggregate_datatypes)
+    counts['Before'] = sum(counts[d] for d in aggregate_datatypes if 'Before' in d)
+    counts['After'] = sum(counts[d] for d in aggregate_datatypes if 'After' in d)
+    return counts
 
-    # Set the plane that we want to calculate density over.
-    if axis == 'y':
-        c0, c1 = 'z', 'x'
-    elif axis == 'x':
-        c0, c1 = 'y', 'z'
-    else:
-        c0, c1 = 'x', 'y'
-
-    density = {}
-    # Go through the study types: learner, nonlearner, ...
-    for t, counts in binned_synapses.items():
-        # Now collapse in one dimension:
-        counts2d = counts.sum(axis).transpose()
-        if mode == 'bin':
-            # Calculate denstity by normalizing by the total number of synapses in each bin.
-           density[t] = (counts2d / counts2d['All']).fillna(0)
-        elif mode == 'total':
-            # Normalize by the total number of synapses .
-            density[t] = (counts2d / counts2d['All'].sum()).fillna(0)
-        else: # mode = density:
-            # Use the number of synapes in each type
-            density[t] = (counts2d / counts.sum()).fillna(0)
-
-        dmax = density[t].max()*threshold
-        density[t] = density[t].where(density[t] > dmax, 0)
-
-        density[t].attrs = counts.attrs
-        density[t].attrs['type'] = 'density'
-
-
-        # Now compute the center of mass
-        plane_mass = density[t].sum(c0)
-        centermass_0 = (plane_mass.coords[c1] * plane_mass).sum() / plane_mass.sum()
-
-        plane_mass = density[t].sum(c1)
-        centermass_1 = (plane_mass.coords[c0] * plane_mass).sum() / plane_mass.sum()
-
-        for k in centermass_0.data_vars:
-            density[t][k].attrs['center_of_mass'] = (float(centermass_0[k]), float(centermass_1[k]))
-            print('2d COM:', t, k, density[t][k].attrs['center_of_mass'])
-    return density
 
+def count_dataset(smin, smax, binsize):
+    """
+    Create an empty dataset for binned synapse counts.
+    """
+    ds = xr.Dataset()
+    ds.attrs['binsize'] = binsize
+    ds.attrs['min'] = smin
+    ds.attrs['max'] = smax
+    ds.attrs['type'] = 'count'
+    return ds
 
-def synapse_density3d(binned_synapses, threshold=0):
+
+class DensityAccumulator(object):
     """
-    Compute the density of a set of synapses. Input is a dictionary with key: All, PairedBefore, PairedAfter, ....
-    :param studylist:
-    :param nbins:
-    :param axis:
-    :return:
+    Synapse counts on a fixed grid, built up one study, or one chunk of points, at a time.  The bounds and bin size are
+    given up front rather than found from the points, so a cohort can be binned without holding all of it in memory,
+    and new studies can be added to existing counts.  Accumulators with the same grid that were built separately,
+    i.e. in different processes, can be merged.
+    """
+
+    def __init__(self, smin, smax, binsize):
+        """
+        :param smin: (min_x, min_y, min_z) of the grid
+        :param smax: (max_x, max_y, max_z) of the grid
+        :param binsize: size of each voxel.  Points outside of the grid are not counted.
+        """
+        self.smin = tuple(smin)
+        self.smax = tuple(smax)
+        self.binsize = binsize
+        self.edges = bin_edges(self.smin, self.smax, binsize)
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self.counts = {}
+
+    def type_counts(self, study_type):
+        if study_type not in self.counts:
+            self.counts[study_type] = {d: np.zeros(int(np.prod(self.shape))) for d in aggregate_datatypes}
+        return self.counts[study_type]
+
+    def add_voxels(self, study_type, datatype, voxels):
+        """
+        Count synapses that have already been mapped to voxels with voxel_index.
+        """
+        counts = self.type_counts(study_type)[datatype]
+        counts += np.bincount(voxels, minlength=counts.size)
+
+    def add_points(self, study_type, datatype, pts):
+        """
+        Count a chunk of points.
+        :param study_type: type of the study the points come from, i.e. learner
+        :param datatype: one of PairedBefore, PairedAfter, UnpairedBefore, UnpairedAfter
+        :param pts: array whose first three columns are aligned x, y, z
+        """
+        self.add_voxels(study_type, datatype, voxel_index(np.asarray(pts), self.edges))
+
+    def add_study(self, s, r=None):
+        """
+        Count the aligned synapses of a study.
+        :param s: the study
+        :param r: the pairing radius, by default the smallest one in the study.
+        """
+        r = min(s['AlignedUnpairedBefore']) if r is None else r
+        for d in aggregate_datatypes:
+            self.add_points(s['Type'], d, aligned_points(s, d, r))
+
+    def add_studies(self, studylist, r=None):
+        for s in studylist:
+            self.add_study(s, r)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts from another accumulator with the same grid into this one.
+        """
+        if (self.smin, self.smax, self.binsize) != (other.smin, other.smax, other.binsize):
+            raise ValueError('Accumulators have different grids')
+        for t, counts in other.counts.items():
+            mine = self.type_counts(t)
+            for d in aggregate_datatypes:
+                mine[d] += counts[d]
+        return self
+
+    def datasets(self):
+        """
+        Get the counts in the same form as bin_synapses: a dataset of counts for each study type and the pseudo type
+        all.
+        """
+        coords = {'x': self.edges[0][:-1], 'y': self.edges[1][:-1], 'z': self.edges[2][:-1]}
+        totals = {d: sum(c[d] for c in self.counts.values()) + np.zeros(int(np.prod(self.shape)))
+                  for d in aggregate_datatypes}
+        binned_synapses = {}
+        for t, counts in list(self.counts.items()) + [('all', totals)]:
+            counts = group_counts(counts)
+            ds = count_dataset(self.smin, self.smax, self.binsize)
+            for g in aggregate_groups:
+                ds[g] = xr.DataArray(counts[g].reshape(self.shape), coords=coords, dims=['x', 'y', 'z'])
+            binned_synapses[t] = ds
+        return binned_synapses
+
+
+def dense_counts(ds):
+    """
+    Expand a sparse dataset from bin_synapses(..., sparse=True) into the full x, y, z grid.
+    """
+    edges = bin_edges(ds.attrs['min'], ds.attrs['max'], ds.attrs['binsize'])
+    shape = tuple(len(e) - 1 for e in edges)
+    idx = np.ravel_multi_index([np.searchsorted(e, ds[c].values) for e, c in zip(edges, ['x', 'y', 'z'])], shape)
+    dense = xr.Dataset(attrs=dict(ds.attrs))
+    for k in ds.data_vars:
+        counts = np.zeros(int(np.prod(shape)))
+        counts[idx] = ds[k].values
+        dense[k] = xr.DataArray(counts.reshape(shape),
+                                coords={'x': edges[0][:-1], 'y': edges[1][:-1], 'z': edges[2][:-1]},
+                                dims=['x', 'y', 'z'])
+    return dense
+
+
+def coarsen_counts(ds, factor):
+    """
+    Make a coarser version of a dataset of counts by adding up blocks of factor x factor x factor voxels.  Blocks at
+    the upper end of an axis may be partly outside of the grid, the same as the last bin of bin_synapses.
+    """
+    if factor == 1:
+        return ds
+    if 'voxel' in ds.dims:
+        ds = dense_counts(ds)
+    coarse = count_dataset(ds.attrs['min'], ds.attrs['max'], ds.attrs['binsize'] * factor)
+    coarse.attrs = dict(ds.attrs, **coarse.attrs)
+    coords = {c: ds[c].values[::factor] for c in ['x', 'y', 'z']}
+    for k in ds.data_vars:
+        counts = ds[k].transpose('x', 'y', 'z').values
+        shape = [-(-n // factor) for n in counts.shape]
+        padded = np.zeros([n * factor for n in shape])
+        padded[:counts.shape[0], :counts.shape[1], :counts.shape[2]] = counts
+        coarse[k] = xr.DataArray(padded.reshape(shape[0], factor, shape[1], factor, shape[2], factor).sum((1, 3, 5)),
+                                 coords=coords, dims=['x', 'y', 'z'])
+    return coarse
+
+
+class DensityPyramid(object):
+    """
+    Binned synapses at several resolutions.  The synapses are only binned once, at the finest resolution, and each
+    coarser level is made by adding up blocks of the finest bins the first time it is asked for.  Levels are named by
+    their nbins.  Only levels whose nbins divides the nbins of the finest level can be made this way, so with 100 bins
+    they are 1, 2, 4, 5, 10, 20, 25, 50 and 100.  Any other level is binned from the aligned points of the studies,
+    which are gathered once and kept, if the pyramid was made with from_studies, and is an error otherwise.
     """
 
-    density = {}
-    # Go through the study types: learner, nonlearner, ...
-    for t, counts in binned_synapses.items():
-        # Use the number of synapes in each type
-        density[t] = (counts / counts.sum()).fillna(0)
+    def __init__(self, binned_synapses, nbins, studylist=None, cache=None, points=None):
+        """
+        :param binned_synapses: the result of bin_synapses(studylist, nbins)
+        :param nbins: the number of bins it was built with
+        :param studylist: the studies, which are binned again for levels that can't be made from the finest one.
+        :param cache: cache argument for bin_synapses when binning the studies again.
+        :param points: the result of aggregate_points(studylist), which is computed when it is first needed if it is
+                       not given.
+        """
+        self.nbins = nbins
+        self.levels = {nbins: binned_synapses}
+        self.studylist = studylist
+        self.cache = cache
+        self.points = points
+
+    @classmethod
+    def from_studies(cls, studylist, nbins=100, cache=None):
+        # Without a cache the points have to be gathered to bin the finest level, so keep them for the other levels.
+        points = None if cache else aggregate_points(studylist)
+        return cls(bin_synapses(studylist, nbins=nbins, cache=cache, points=points), nbins, studylist, cache, points)
+
+    def available(self):
+        """
+        The nbins of each level that the pyramid can make from the finest level, without binning the studies again.
+        """
+        return [n for n in range(1, self.nbins + 1) if self.nbins % n == 0]
+
+    def level(self, nbins=None):
+        """
+        Get the binned synapses for a level.
+        :param nbins: the level, by default the finest one.  Levels that are not in available() are binned from the
+                      aligned points of the studies.
+        :return: dictionary of study type to dataset of counts, the same as bin_synapses(studylist, nbins)
+        """
+        nbins = self.nbins if nbins is None else nbins
+        if nbins not in self.levels:
+            if nbins <= 0:
+                raise ValueError('Level {0} has to be positive'.format(nbins))
+            if self.nbins % nbins == 0:
+                self.levels[nbins] = {t: coarsen_counts(ds, self.nbins // nbins)
+                                      for t, ds in self.levels[self.nbins].items()}
+            elif self.studylist is not None:
+                if self.points is None:
+                    self.points = aggregate_points(self.studylist)
+                self.levels[nbins] = bin_synapses(self.studylist, nbins=nbins, cache=self.cache, points=self.points)
+            else:
+                raise ValueError('Level {0} is not one of {1}, and there are no studies to bin it from'.format(
+                    nbins, self.available()))
+        return self.levels[nbins]
+
+
+# Plane for the projection along each axis, and the ways that a projection can be normalized.
+projection_planes = {'y': ('z', 'x'), 'x': ('y', 'z'), 'z': ('x', 'y')}
+density_modes = ['bin', 'total', 'density']
+
+
+def stack_counts(binned_synapses):
+    """
+    Put the counts for every study type and datatype into one array with dimensions type, datatype, x, y, z.
+    """
+    types = list(binned_synapses)
+    return xr.concat([(dense_counts(ds) if 'voxel' in ds.dims else ds).to_array('datatype').transpose(
+                      'datatype', 'x', 'y', 'z') for ds in binned_synapses.values()],
+                     dim=pd.Index(types, name='type'))
 
-        dmax = density[t].max() * threshold
-        density[t] = density[t].where(density[t] > dmax, 0)
 
-        density[t].attrs = counts.attrs
-        density[t].attrs['type'] = 'density'
+def center_of_mass(density, dims, name='com'):
+    """
+    Compute the center of mass of a density in each of a list of dimensions.
+    :param name: name of the dimension that the results for the dimensions are along.
+    """
+    com = []
+    for c in dims:
+        plane_mass = density.sum([d for d in dims if d != c])
+        com.append((plane_mass[c] * plane_mass).sum(c) / plane_mass.sum(c))
+    return xr.concat(com, dim=pd.Index(list(dims), name=name))
 
-        # Now compute the center of mass
-        plane_mass = density[t].sum(['y']).sum(['z'])
-        centermass_x = (plane_mass.coords['x'] * plane_mass).sum() / plane_mass.sum()
 
-        plane_mass = density[t].sum(['x']).sum(['z'])
-        centermass_y = (plane_mass.coords['y'] * plane_mass).sum() / plane_mass.sum()
+def density_summary(binned_synapses, threshold=0, level=None, axes=('x', 'y', 'z'), modes=density_modes, cache=None):
+    """
+    Compute the 3D density, the projection along each axis in each normalization mode, and all of their centers of
+    mass, for every study type and datatype at once.
+    :param binned_synapses: result of bin_synapses, or a DensityPyramid
+    :param threshold: fraction of the largest density below which the density is set to 0.  A list of thresholds
+                      gives a threshold dimension in the result.
+    :param level: If binned_synapses is a DensityPyramid, the nbins of the level to use.
+    :param axes: axes to project along
+    :param modes: bin to normalize by the total synapses in each bin, total to normalize by the total synapses, or
+                  density to normalize by the synapses of each datatype.
+    :param cache: a ResultCache, or True for the default one, to reuse the result.  Only used if binned_synapses came
+                  from bin_synapses(..., cache=...), as otherwise there is no key for where the counts came from.
+    :return: Dataset with density3d and com3d, and density_<axis> and com_<axis> for each axis.  Each center of mass
+             is along a com3d_dims or com_<axis>_dims dimension with the coordinates it is in.
+    """
+    if isinstance(binned_synapses, DensityPyramid):
+        binned_synapses = binned_synapses.level(level)
+    sources = [dict(ds.attrs, Type=t) for t, ds in binned_synapses.items()]
+    if cache and all('SourceKey' in a for a in sources):
+        key = synapse_cache.result_key(density_version, sources, 'density_summary', np.atleast_1d(threshold).tolist(),
+                                       np.ndim(threshold), list(axes), list(modes))
+        return result_cache(cache).get(key, lambda: density_summary(binned_synapses, threshold, axes=axes, modes=modes))
+
+    counts = stack_counts(binned_synapses)
+    thresholds = xr.DataArray(np.atleast_1d(threshold), dims='threshold',
+                              coords={'threshold': np.atleast_1d(threshold)})
+    if np.ndim(threshold) == 0:
+        thresholds = thresholds.squeeze('threshold')
+
+    result = xr.Dataset(attrs=dict(next(iter(binned_synapses.values())).attrs, type='density'))
+    space = ['x', 'y', 'z']
+    density = (counts / counts.sum(space)).fillna(0)
+    density = density.where(density > density.max(space) * thresholds, 0)
+    result['density3d'] = density
+    result['com3d'] = center_of_mass(density, space, 'com3d_dims')
+
+    for axis in axes:
+        c0, c1 = projection_planes[axis]
+        counts2d = counts.sum(axis)
+        total = counts2d.sel(datatype='All', drop=True)
+        normalized = {'bin': lambda: counts2d / total,
+                      'total': lambda: counts2d / total.sum([c0, c1]),
+                      'density': lambda: counts2d / counts2d.sum([c0, c1])}
+        density = xr.concat([normalized[m]() for m in modes], dim=pd.Index(list(modes), name='mode')).fillna(0)
+        density = density.where(density > density.max([c0, c1]) * thresholds, 0)
+        result['density_' + axis] = density.transpose(..., *reversed([c for c in space if c != axis]))
+        result['com_' + axis] = center_of_mass(density, [c1, c0], 'com_{0}_dims'.format(axis))
+    return result
+
+
+def density_datasets(density, com, attrs):
+    """
+    Split a density from density_summary into a dataset for each study type, with the datatypes as variables and the
+    center of mass of each in its attributes, which is the form that synapse_density returns.
+    """
+    result = {}
+    for t in density['type'].values:
+        ds = density.sel(type=t, drop=True).to_dataset('datatype')
+        ds.attrs = dict(attrs)
+        for k in ds.data_vars:
+            ds[k].attrs['center_of_mass'] = tuple(float(v) for v in com.sel(type=t, datatype=k).values.ravel())
+        result[t] = ds
+    return result
 
-        plane_mass = density[t].sum(['x']).sum(['y'])
-        centermass_z = (plane_mass.coords['z'] * plane_mass).sum() / plane_mass.sum()
 
-        for k in centermass_x.data_vars:
-            density[t][k].attrs['center_of_mass'] = \
-                (float(centermass_x[k]), float(centermass_y[k]), float(centermass_z[k]))
+def synapse_density(binned_synapses, axis='y', mode='density', threshold=0, level=None, cache=None):
+    """
+    Compute the density of a set of synapses. Input is a dictionary with key: All, PairedBefore, PairedAfter, ....
+    :param studylist:
+    :param nbins:
+    :param axis:
+    :param level: If binned_synapses is a DensityPyramid, the nbins of the level to use.
+    :param cache: a ResultCache, or True for the default one, to reuse the result, see density_summary.
+    :return:
+    """
+    mode = mode if mode in density_modes else 'density'
+    summary = density_summary(binned_synapses, threshold=threshold, level=level, axes=[axis], modes=[mode],
+                              cache=cache)
+    density = density_datasets(summary['density_' + axis].sel(mode=mode, drop=True),
+                               summary['com_' + axis].sel(mode=mode, drop=True), summary.attrs)
+    for t, ds in density.items():
+        for k in ds.data_vars:
+            print('2d COM:', t, k, ds[k].attrs['center_of_mass'])
     return density
 
 
+def synapse_density3d(binned_synapses, threshold=0, level=None, cache=None):
+    """
+    Compute the density of a set of synapses. Input is a dictionary with key: All, PairedBefore, PairedAfter, ....
+    :param studylist:
+    :param nbins:
+    :param axis:
+    :param level: If binned_synapses is a DensityPyramid, the nbins of the level to use.
+    :param cache: a ResultCache, or True for the default one, to reuse the result, see density_summary.
+    :return:
+    """
+    summary = density_summary(binned_synapses, threshold=threshold, level=level, axes=[], cache=cache)
+    return density_datasets(summary['density3d'], summary['com3d'], summary.attrs)
@@ -0,0 +1,367 @@
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+# Columns of the synapse arrays we keep for each timepoint
+point_columns = ['z', 'y', 'x', 'core', 'hollow']
+
+pair_types = ['PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter']
+
+
+def transform_points(M, points, dtype=np.float32):
+    """
+    Map points with a 4x4 alignment matrix in a single matrix multiply.  This uses the same convention as synspy's
+    transform_points: each point is a homogeneous row vector [x, y, z, 1] that is multiplied on the left of M.
+    :param M: the alignment matrix, i.e. ImageGrossAlignment.M_canonical
+    :param points: array whose first three columns are x, y, z
+    :param dtype: type of the homogeneous coordinates, float32 as in synspy.
+    :return: array with columns x, y, z
+    """
+    a = np.ones((len(points), 4), dtype=dtype)
+    a[:, 0:3] = points[:, 0:3]
+    return np.matmul(a, M)[:, 0:3]
+
+
+# Columns of the summary table that SynapseSet.summary builds.
+summary_columns = ['DataType', 'Radius', 'Aligned', 'Count', 'MinX', 'MinY', 'MinZ', 'MaxX', 'MaxY', 'MaxZ',
+                   'MeanX', 'MeanY', 'MeanZ', 'XX', 'YY', 'ZZ', 'XY', 'XZ', 'YZ']
+
+
+def threshold_stats(xyz, distance, radii):
+    """
+    Compute the count, bounds, centroid and second moments of the points within each radius, and of the points that
+    are not, in one pass.  Points are sorted by match distance, so the points within a radius are a prefix of the
+    sorted points and running sums from each end give the statistics for every radius.
+    :param xyz: array with columns x, y, z
+    :param distance: match distance for each point, inf if the point is unpaired.  Points are within a radius if
+                     their distance is less than it.
+    :param radii: list of radii
+    :return: (paired, unpaired), each a list of the statistics for each radius in the order of summary_columns.
+    """
+    order = np.argsort(distance, kind='stable')
+    pts = np.asarray(xyz, dtype=np.float64)[order]
+    k = np.searchsorted(distance[order], radii, side='left')
+    products = pts[:, [0, 1, 2, 0, 0, 1]] * pts[:, [0, 1, 2, 1, 2, 2]]
+
+    def running(pts, products):
+        # Statistics of the first i points are in row i, with row 0 for no points.
+        n = len(pts)
+        pad = [[np.inf] * 3]
+        return (np.arange(n + 1),
+                np.concatenate([pad, np.minimum.accumulate(pts)]) if n else np.array(pad),
+                np.concatenate([np.negative(pad), np.maximum.accumulate(pts)]) if n else np.negative(pad),
+                np.concatenate([np.zeros((1, 3)), np.cumsum(pts, axis=0)]),
+                np.concatenate([np.zeros((1, 6)), np.cumsum(products, axis=0)]))
+
+    def stats(count, lo, hi, total, moments):
+        if count == 0:
+            return [0] + [np.nan] * 15
+        mean = total / count
+        central = moments / count - mean[[0, 1, 2, 0, 0, 1]] * mean[[0, 1, 2, 1, 2, 2]]
+        return [int(count)] + list(lo) + list(hi) + list(mean) + list(central)
+
+    head = running(pts, products)
+    tail = running(pts[::-1], products[::-1])
+    n = len(pts)
+    paired = [stats(*[a[i] for a in head]) for i in k]
+    unpaired = [stats(*[a[n - i] for a in tail]) for i in k]
+    return paired, unpaired
+
+
+class SynapseSet(object):
+    """
+    Compact representation of the synapses in a study.  The before and after point clouds are each kept once as
+    contiguous arrays, along with the partner of each point, rather than as separate copies for each radius.
+
+    For a mutual nearest neighbour pairing the pairs at a smaller radius are the ones whose match distance is within
+    it, so pairing is only computed once, at the largest radius, and the other radii are found by thresholding the
+    distance.  Other pairings, such as the greedy one in synspy, can pair a synapse at a smaller radius with one that
+    was used by another pair at the largest radius, so a partner array is kept for each radius instead.
+
+    Arrays are kept in a dictionary keyed by (name, radius):
+        ('Before', None), ('After', None): arrays with columns z, y, x, core, hollow
+        ('BeforePartner', r): index of the after synapse paired with each before synapse at radius r, or -1 if
+            unpaired.  r is None for a thresholded pairing.
+        ('AfterPartner', r): index of the before synapse paired with each after synapse, or -1 if unpaired.
+        ('BeforeDistance', None), ('AfterDistance', None): distance from each synapse to its partner, only for a
+            thresholded pairing.  A synapse is paired at radius r if its distance is less than r.
+    """
+
+    def __init__(self, arrays, radii, transform=None, max_radius=None):
+        """
+        :param arrays: dictionary of arrays as described above.
+        :param radii: list of radii that are presented as views of the study.
+        :param transform: matrix that maps the points into the canonical space, or None if the study is not aligned.
+        :param max_radius: radius the pairing was computed at, which is the largest radius that can be asked for.
+        """
+        self.arrays = arrays
+        self.radii = list(radii)
+        self.transform = transform
+        self.max_radius = max(self.radii) if max_radius is None else max_radius
+        self.aligned_arrays = {}
+
+    def __getstate__(self):
+        # The aligned point clouds can always be computed again, so don't save them.
+        state = dict(self.__dict__)
+        state['aligned_arrays'] = {}
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('aligned_arrays', {})
+        self.__dict__.update(state)
+
+    @classmethod
+    def from_pairing(cls, s1, s2, radii, s1_to_s2, s2_to_s1, distance, transform=None, float32=False):
+        """
+        Build a synapse set from a mutual nearest neighbour pairing of two point clouds at the largest radius.
+        :param s1: array of before synapses, whose first five columns are z, y, x, core, hollow
+        :param s2: array of after synapses
+        :param radii: radii the pairs are wanted for
+        :param s1_to_s2: pairing map from s1 to s2 at max(radii)
+        :param s2_to_s1: pairing map from s2 to s1 at max(radii)
+        :param distance: match distance of each before synapse, in the space the pairing was done in.
+        :param transform: alignment matrix for the study or None
+        :param float32: store the points as float32 to save memory.
+        :return: a SynapseSet
+        """
+        dtype = np.float32 if float32 else None
+        before = np.ascontiguousarray(s1[:, 0:5], dtype=dtype)
+        after = np.ascontiguousarray(s2[:, 0:5], dtype=dtype)
+        s1_to_s2 = np.asarray(s1_to_s2, dtype=np.int32)
+        s2_to_s1 = np.asarray(s2_to_s1, dtype=np.int32)
+
+        paired = s1_to_s2 >= 0
+        distance = np.asarray(distance, dtype=before.dtype)
+
+        after_distance = np.full(len(after), np.inf, dtype=before.dtype)
+        after_distance[s1_to_s2[paired]] = distance[paired]
+        arrays = {('Before', None): before, ('After', None): after,
+                  ('BeforePartner', None): s1_to_s2, ('AfterPartner', None): s2_to_s1,
+                  ('BeforeDistance', None): distance, ('AfterDistance', None): after_distance}
+        return cls(arrays, radii, transform, max_radius=max(radii))
+
+    @classmethod
+    def from_pairing_maps(cls, s1, s2, radii, s1_to_s2, s2_to_s1, transform=None, float32=False):
+        """
+        Build a synapse set from pairing maps that were computed separately for each radius, i.e. by
+        SynapticPairStudy.syn_pairing_maps(radii).
+        :param s1: array of before synapses, whose first five columns are z, y, x, core, hollow
+        :param s2: array of after synapses
+        :param radii: the radii the maps were computed for
+        :param s1_to_s2: array with the pairing map from s1 to s2 for each radius
+        :param s2_to_s1: array with the pairing map from s2 to s1 for each radius
+        :param transform: alignment matrix for the study or None
+        :param float32: store the points as float32 to save memory.
+        :return: a SynapseSet
+        """
+        dtype = np.float32 if float32 else None
+        arrays = {('Before', None): np.ascontiguousarray(s1[:, 0:5], dtype=dtype),
+                  ('After', None): np.ascontiguousarray(s2[:, 0:5], dtype=dtype)}
+        for i, r in enumerate(radii):
+            arrays[('BeforePartner', r)] = np.asarray(s1_to_s2[i], dtype=np.int32)
+            arrays[('AfterPartner', r)] = np.asarray(s2_to_s1[i], dtype=np.int32)
+        return cls(arrays, radii, transform, max_radius=max(radii))
+
+    def thresholded(self):
+        """
+        True if the pairs for every radius are found from the match distances of a single pairing.
+        """
+        return ('BeforeDistance', None) in self.arrays
+
+    def partner(self, name, r):
+        """
+        Return the array with the partner of each synapse in the named point cloud at radius r.  For a thresholded
+        pairing this is the partner at the largest radius, which is only a pair at r if paired says so.
+        """
+        if r > self.max_radius:
+            raise KeyError(r)
+        return self.arrays[(name + 'Partner', None if self.thresholded() else r)]
+
+    def select(self, radii):
+        """
+        Return a synapse set that only presents some of the radii.  The arrays are shared.
+        """
+        synapses = SynapseSet(self.arrays, [r for r in self.radii if r in radii], self.transform, self.max_radius)
+        synapses.aligned_arrays = self.aligned_arrays
+        return synapses
+
+    def skeleton(self):
+        """
+        Return an empty synapse set with the same radii and transform, to which arrays can be added.
+        """
+        return SynapseSet({}, self.radii, self.transform, self.max_radius)
+
+    def paired(self, name, r):
+        """
+        Return a mask of the synapses in the named point cloud that are paired at radius r.
+        """
+        partner = self.partner(name, r)
+        if not self.thresholded():
+            return partner >= 0
+        return (partner >= 0) & (self.arrays[(name + 'Distance', None)] < r)
+
+    def indices(self, ptype, r):
+        """
+        Find the synapses of a given pair type at radius r.
+        :param ptype: one of PairedBefore, PairedAfter, UnpairedBefore, UnpairedAfter
+        :param r: the radius, which can be any radius up to the one used for pairing.
+        :return: the name of the point cloud and an index array into it.
+        """
+        if ptype == 'PairedBefore':
+            return 'Before', np.nonzero(self.paired('Before', r))[0]
+        elif ptype == 'PairedAfter':
+            return 'After', self.partner('Before', r)[self.paired('Before', r)]
+        elif ptype == 'UnpairedBefore':
+            return 'Before', np.nonzero(~self.paired('Before', r))[0]
+        elif ptype == 'UnpairedAfter':
+            return 'After', np.nonzero(~self.paired('After', r))[0]
+        raise KeyError(ptype)
+
+    def aligned(self, name):
+        """
+        Get a point cloud in the canonical space.  The transform is applied to the whole point cloud the first time
+        it is asked for, and the aligned synapses for each radius and pair type are taken from the result.
+        :param name: Before or After
+        :return: array with columns x, y, z, core
+        """
+        if self.transform is None:
+            raise KeyError(name)
+        pts = self.aligned_arrays.get(name)
+        if pts is None:
+            pts = self.arrays[(name, None)]
+            xyz = transform_points(self.transform, pts[:, [2, 1, 0]])
+            pts = np.column_stack([xyz[:, 0:3], pts[:, 3]]).astype(pts.dtype, copy=False)
+            self.aligned_arrays[name] = pts
+        return pts
+
+    def summary(self, radii=None):
+        """
+        Summarize the synapses of each pair type at each radius, both in the image space and in the canonical space if
+        the study is aligned.  Bounds and counts can then be found without going through the points.
+        :param radii: list of radii to summarize, by default the radii of the synapse set.
+        :return: DataFrame with the columns in summary_columns and a row for each datatype, radius and alignment.
+        """
+        radii = self.radii if radii is None else list(radii)
+        if radii and max(radii) > self.max_radius:
+            raise ValueError('Radius larger than pairing radius {0}'.format(self.max_radius))
+        rows = []
+        for aligned in [False, True] if self.transform is not None else [False]:
+            prefix = 'Aligned' if aligned else ''
+            for name in ['Before', 'After']:
+                xyz = self.aligned(name)[:, 0:3] if aligned else self.arrays[(name, None)][:, [2, 1, 0]]
+                if self.thresholded():
+                    distance = np.where(self.arrays[(name + 'Partner', None)] >= 0,
+                                        self.arrays[(name + 'Distance', None)], np.inf)
+                    paired, unpaired = threshold_stats(xyz, distance, radii)
+                else:
+                    # Each radius has its own pairs, so put the synapses paired at it at distance 0.
+                    stats = [threshold_stats(xyz, np.where(self.paired(name, r), 0, np.inf), [r]) for r in radii]
+                    paired, unpaired = [p[0] for p, u in stats], [u[0] for p, u in stats]
+                for r, p, u in zip(radii, paired, unpaired):
+                    rows.append([prefix + 'Paired' + name, r, aligned] + p)
+                    rows.append([prefix + 'Unpaired' + name, r, aligned] + u)
+        return pd.DataFrame(rows, columns=summary_columns)
+
+    def pairing_rate(self, radii):
+        """
+        Count the pairs at each of a list of radii without computing the pairing again.
+        :param radii: list of radii, none of which can be larger than the radius used for pairing.  If the pairs were
+                      computed separately for each radius, only those radii can be used.
+        :return: DataFrame with the number of pairs and the fraction of before and after synapses paired at each radius.
+        """
+        radii = np.asarray(radii, dtype=float)
+        if np.any(radii > self.max_radius):
+            raise ValueError('Radius larger than pairing radius {0}'.format(self.max_radius))
+        if self.thresholded():
+            distance = self.arrays[('BeforeDistance', None)]
+            distance = np.sort(distance[self.arrays[('BeforePartner', None)] >= 0])
+            pairs = np.searchsorted(distance, radii, side='left')
+        else:
+            missing = [float(r) for r in radii if ('BeforePartner', r) not in self.arrays]
+            if missing:
+                raise ValueError('Pairs were not computed for radii {0}'.format(missing))
+            pairs = np.array([np.count_nonzero(self.paired('Before', r)) for r in radii], dtype=np.int64)
+        nbefore, nafter = len(self.arrays[('Before', None)]), len(self.arrays[('After', None)])
+        return pd.DataFrame({'Radius': radii, 'Pairs': pairs,
+                             'UnpairedBefore': nbefore - pairs, 'UnpairedAfter': nafter - pairs,
+                             'BeforeRate': pairs / max(nbefore, 1), 'AfterRate': pairs / max(nafter, 1)})
+
+    def points(self, ptype, r, aligned=False):
+        """
+        Get the synapses of a given pair type as an array.
+        :param ptype: one of PairedBefore, PairedAfter, UnpairedBefore, UnpairedAfter
+        :param r: the radius
+        :param aligned: If true, return x, y, z, core in the canonical space, otherwise z, y, x, core, hollow.
+        :return: an array of points
+        """
+        name, idx = self.indices(ptype, r)
+        return self.aligned(name)[idx] if aligned else self.arrays[(name, None)][idx]
+
+    def frame(self, datatype, r):
+        """
+        Get the synapses for a datatype such as AlignedPairedBefore or UnpairedAfterCentroid as a DataFrame in the
+        same form that was used in the original study dictionaries.
+        """
+        aligned = datatype.startswith('Aligned')
+        ptype = datatype[len('Aligned'):] if aligned else datatype
+        centroid = ptype.endswith('Centroid')
+        ptype = ptype[:-len('Centroid')] if centroid else ptype
+
+        if aligned and self.transform is None:
+            raise KeyError(datatype)
+        pts = pd.DataFrame(self.points(ptype, r, aligned),
+                           columns=['x', 'y', 'z', 'core'] if aligned else point_columns)
+        if centroid:
+            return pd.DataFrame.from_records([(pts['x'].mean(), pts['y'].mean(), pts['z'].mean())],
+                                             columns=['x', 'y', 'z'])
+        return pts
+
+    def datatypes(self):
+        datatypes = pair_types + [p + 'Centroid' for p in pair_types]
+        if self.transform is not None:
+            datatypes = datatypes + ['Aligned' + p for p in datatypes]
+        return datatypes
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self.arrays.values())
+
+
+class SynapseView(Mapping):
+    """
+    Compatibility view so that s['PairedBefore'][r]['Data'] still works for studies whose synapses are held in a
+    SynapseSet.  The record for a radius is built when it is asked for.
+    """
+
+    def __init__(self, synapses, datatype, study, study_type):
+        self.synapses = synapses
+        self.datatype = datatype
+        self.study = study
+        self.study_type = study_type
+
+    def __getitem__(self, r):
+        if r not in self.synapses.radii:
+            raise KeyError(r)
+        return {'Data': self.synapses.frame(self.datatype, r),
+                'DataType': self.datatype, 'Study': self.study, 'Radius': r, 'Type': self.study_type}
+
+    def __iter__(self):
+        return iter(self.synapses.radii)
+
+    def __len__(self):
+        return len(self.synapses.radii)
+
+
+def add_views(s):
+    """
+    Add the compatibility views for each datatype to a study that has a SynapseSet in s['Synapses'].
+    """
+    for datatype in s['Synapses'].datatypes():
+        s[datatype] = SynapseView(s['Synapses'], datatype, s['Study'], s['Type'])
+    return s
+
+
+def remove_views(s):
+    """
+    Return a copy of a study without the compatibility views.
+    """
+    return {k: v for k, v in s.items() if not isinstance(v, SynapseView)}
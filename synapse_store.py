@@ -0,0 +1,516 @@
+import os
+import io
+import tempfile
+import struct
+import pickle
+import functools
+import numpy as np
+import pandas as pd
+import xarray as xr
+from synapse_set import add_views, remove_views
+
+# Name of the metadata index inside of a columnar studyset directory.
+index_name = 'index.pkl'
+block_dir = 'blocks'
+cube_dir = 'cubes'
+
+# An indexed archive starts with this marker, followed by the length of the header as an unsigned 64 bit integer.
+archive_magic = b'SYNARC01'
+archive_prefix = struct.Struct('<8sQ')
+
+
+class LazyRecord(dict):
+    """
+    A per-radius study record, i.e. s['PairedBefore'][4], whose 'Data' frame is only read from disk the first time
+    it is accessed.  All of the other values in the record (DataType, Study, Radius, Type) are available right away.
+    """
+
+    def __init__(self, loader, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._loader = loader
+
+    def __missing__(self, key):
+        if key != 'Data':
+            raise KeyError(key)
+        self['Data'] = self._loader()
+        return self['Data']
+
+    def __contains__(self, key):
+        return key == 'Data' or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def loaded(self):
+        return dict.__contains__(self, 'Data')
+
+    def __reduce__(self):
+        # Pickle as a plain dictionary so that a restored studyset can be dumped in any format.
+        return dict, (dict(self, Data=self['Data']),)
+
+
+class LazyArrays(dict):
+    """
+    The arrays of a SynapseSet, each of which is only read from disk the first time it is accessed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._loaders = {}
+
+    def add_loader(self, key, loader):
+        self._loaders[key] = loader
+
+    def __missing__(self, key):
+        self[key] = self._loaders.pop(key)()
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self._loaders or dict.__contains__(self, key)
+
+    def keys(self):
+        return list(dict.keys(self)) + list(self._loaders)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._loaders)
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+
+def study_blocks(study):
+    """
+    Find all of the point data in a study that uses DataFrames.  Point data is stored as s[datatype][radius]['Data']
+    for datatypes such as PairedBefore, AlignedUnpairedAfter or PairedBeforeCentroid.  Records that have not been
+    loaded yet are found without reading them.
+    :param study: a study dictionary
+    :return: a list of (datatype, radius) tuples.
+    """
+    blocks = []
+    for datatype, v in study.items():
+        if not isinstance(v, dict):
+            continue
+        for r, record in v.items():
+            if isinstance(record, LazyRecord) or (isinstance(record, dict) and
+                                                  isinstance(record.get('Data'), pd.DataFrame)):
+                blocks.append((datatype, r))
+    return blocks
+
+
+def split_studyset(sset):
+    """
+    Separate a studyset into a skeleton, which has all of the metadata but no point data, and a list of point blocks.
+    Studies with a SynapseSet contribute one block for each of its arrays, other studies have a block for each
+    (datatype, radius) DataFrame.
+    :param sset: the studyset to split
+    :return: skeleton, [(study index, kind, datatype, radius, value)]
+    """
+    skeleton = dict(sset)
+    skeleton['Studies'] = []
+    blocks = []
+    for idx, s in enumerate(sset['Studies']):
+        s = remove_views(s)
+        if 'Synapses' in s:
+            synapses = s['Synapses']
+            for (name, r), v in synapses.arrays.items():
+                blocks.append((idx, 'Synapses', name, r, v))
+            s['Synapses'] = synapses.skeleton()
+        for datatype, r in study_blocks(s):
+            s[datatype] = dict(s[datatype])
+            record = dict(s[datatype][r])
+            record.pop('Data', None)
+            blocks.append((idx, 'Record', datatype, r, s[datatype][r]['Data']))
+            s[datatype][r] = record
+        skeleton['Studies'].append(s)
+    return skeleton, blocks
+
+
+def block_entry(idx, kind, datatype, r, value):
+    return {'Study': idx, 'Kind': kind, 'DataType': datatype, 'Radius': r,
+            'Columns': list(value.columns) if isinstance(value, pd.DataFrame) else None}
+
+
+def block_array(value):
+    return value.to_numpy() if isinstance(value, pd.DataFrame) else value
+
+
+def block_value(data, columns):
+    return data if columns is None else pd.DataFrame(data, columns=columns)
+
+
+def block_name(idx, datatype, radius):
+    return '{0:05d}-{1}-{2}.npy'.format(idx, datatype, radius)
+
+
+def load_block(fname, columns):
+    return block_value(np.load(fname), columns)
+
+
+def select_study(s, radii):
+    """
+    Return a copy of a study with just the data for the given radii.
+    """
+    s = dict(s)
+    if 'Synapses' in s:
+        s['Synapses'] = s['Synapses'].select(radii)
+        add_views(s)
+    if 'Summary' in s:
+        s['Summary'] = filter_summary(s['Summary'], radii=radii)
+    for datatype, r in study_blocks(s):
+        if r not in radii:
+            s[datatype] = {k: v for k, v in s[datatype].items() if k != r}
+    return s
+
+
+def filter_summary(summary, studies=None, types=None, radii=None):
+    """
+    Select the rows of a summary table for a subset of a studyset.
+    """
+    keep = np.ones(len(summary), dtype=bool)
+    if studies is not None:
+        keep &= summary['Study'].isin(studies).to_numpy()
+    if types is not None:
+        keep &= summary['Type'].isin(types).to_numpy()
+    if radii is not None:
+        keep &= summary['Radius'].isin(radii).to_numpy()
+    return summary[keep].reset_index(drop=True)
+
+
+def study_selected(s, studies, types):
+    return (studies is None or s['Study'] in studies) and (types is None or s['Type'] in types)
+
+
+def filter_studyset(sset, studies=None, types=None, radii=None):
+    """
+    Select a subset of a studyset.  Any filter that is None is ignored.
+    :param sset: the studyset
+    :param studies: list of study IDs to keep
+    :param types: list of study types, i.e. learner, nonlearner, to keep
+    :param radii: list of pairing radii to keep
+    :return: a new studyset with just the selected studies and radii.
+    """
+    result = dict(sset)
+    result['Studies'] = [s if radii is None else select_study(s, radii)
+                         for s in sset['Studies'] if study_selected(s, studies, types)]
+    if 'Summary' in sset:
+        result['Summary'] = filter_summary(sset['Summary'], studies, types, radii)
+    return result
+
+
+def attach_block(s, entry, loader, lazy):
+    """
+    Put the data for a block back into a study from a skeleton.
+    :param s: the study
+    :param entry: the index entry for the block
+    :param loader: function that returns the value of the block
+    :param lazy: If true, the loader is not called until the data is used.
+    """
+    if entry['Kind'] == 'Synapses':
+        synapses = s['Synapses']
+        if not isinstance(synapses.arrays, LazyArrays):
+            synapses.arrays = LazyArrays(synapses.arrays)
+        if lazy:
+            synapses.arrays.add_loader((entry['DataType'], entry['Radius']), loader)
+        else:
+            synapses.arrays[(entry['DataType'], entry['Radius'])] = loader()
+    else:
+        record = s[entry['DataType']][entry['Radius']]
+        if lazy:
+            s[entry['DataType']][entry['Radius']] = LazyRecord(loader, record)
+        else:
+            s[entry['DataType']][entry['Radius']] = dict(record, Data=loader())
+
+
+def dump_columnar(sset, dirname):
+    """
+    Write a studyset as a directory with one .npy file for each point block and a small pickled index that has
+    everything else.
+    :param sset: the studyset to write out
+    :param dirname: name of the directory, which will be created if needed.
+    :return: None
+    """
+    os.makedirs(os.path.join(dirname, block_dir), mode=0o777, exist_ok=True)
+
+    skeleton, blocks = split_studyset(sset)
+    index = []
+    for idx, kind, datatype, r, value in blocks:
+        entry = block_entry(idx, kind, datatype, r, value)
+        entry['File'] = os.path.join(block_dir, block_name(idx, datatype, r))
+        np.save(os.path.join(dirname, entry['File']), block_array(value))
+        index.append(entry)
+
+    with open(os.path.join(dirname, index_name), 'wb') as fo:
+        pickle.dump({'Studyset': skeleton, 'Blocks': index}, fo)
+
+
+def restore_columnar(dirname, lazy=True):
+    """
+    Restore a studyset that was written with dump_columnar.
+    :param dirname: the directory with the studyset
+    :param lazy: If true, point data is not read until it is first used.
+    :return: the studyset
+    """
+    with open(os.path.join(dirname, index_name), 'rb') as fo:
+        index = pickle.load(fo)
+
+    sset = index['Studyset']
+    for b in index['Blocks']:
+        loader = functools.partial(load_block, os.path.join(dirname, b['File']), b['Columns'])
+        attach_block(sset['Studies'][b['Study']], b, loader, lazy)
+    for s in sset['Studies']:
+        if 'Synapses' in s:
+            add_views(s)
+    return sset
+
+
+def dump_density(binned_synapses, dirname):
+    """
+    Write binned synapses as a directory with one .npy file for each study type and variable, and a small pickled
+    index with the dimensions, coordinates and attributes, including the binsize, min and max of the grid.  Works for
+    the results of bin_synapses, DensityPyramid.level and synapse_density3d.
+    :param binned_synapses: dictionary of study type to dataset
+    :param dirname: name of the directory, which will be created if needed.
+    :return: None
+    """
+    os.makedirs(os.path.join(dirname, cube_dir), mode=0o777, exist_ok=True)
+
+    index = {}
+    for t, ds in binned_synapses.items():
+        entry = {'Attrs': dict(ds.attrs), 'Variables': {},
+                 'Coords': {c: (ds[c].dims, ds[c].values) for c in ds.coords}}
+        for k, v in ds.data_vars.items():
+            fname = os.path.join(cube_dir, '{0}-{1}.npy'.format(t, k))
+            np.save(os.path.join(dirname, fname), np.ascontiguousarray(v.values))
+            entry['Variables'][k] = {'File': fname, 'Dims': v.dims, 'Attrs': dict(v.attrs)}
+        index[t] = entry
+
+    # The index is written last, so a directory that was only partly written can't be opened.
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix='.index-')
+    with os.fdopen(fd, 'wb') as fo:
+        pickle.dump(index, fo)
+    os.replace(tmpfile, os.path.join(dirname, index_name))
+
+
+def restore_density(dirname, types=None, mmap=True):
+    """
+    Open binned synapses that were written with dump_density.
+    :param dirname: the directory with the binned synapses
+    :param types: list of study types to open, or None for all of them
+    :param mmap: If true, the counts are memory mapped rather than read, so selecting a slice, i.e. ds.sel(z=...), or
+                 summing a projection only reads the part of the file that it uses.  The datasets are read only.
+    :return: dictionary of study type to dataset, the same as bin_synapses
+    """
+    with open(os.path.join(dirname, index_name), 'rb') as fo:
+        index = pickle.load(fo)
+
+    binned_synapses = {}
+    for t, entry in index.items():
+        if types is not None and t not in types:
+            continue
+        ds = xr.Dataset(coords=entry['Coords'], attrs=entry['Attrs'])
+        for k, v in entry['Variables'].items():
+            data = np.load(os.path.join(dirname, v['File']), mmap_mode='r' if mmap else None)
+            ds[k] = xr.DataArray(data, dims=v['Dims'], coords={c: ds[c] for c in ds.coords
+                                                               if set(ds[c].dims) <= set(v['Dims'])},
+                                 attrs=v['Attrs'])
+        binned_synapses[t] = ds
+    return binned_synapses
+
+
+def dump_archive(sset, fname):
+    """
+    Write a studyset as a single file that can be partially read.  The file has a header with the metadata for the
+    studyset and a table of the byte offsets for each (study, datatype, radius) block, followed by the blocks
+    themselves in .npy format.  Blocks for a study are written next to each other so they can be read together.
+    :param sset: the studyset to write out
+    :param fname: name of the archive file
+    :return: None
+    """
+    skeleton, blocks = split_studyset(sset)
+
+    index, data = [], []
+    offset = 0
+    for idx, kind, datatype, r, value in blocks:
+        buf = io.BytesIO()
+        np.save(buf, block_array(value))
+        data.append(buf.getvalue())
+        entry = block_entry(idx, kind, datatype, r, value)
+        entry['Offset'], entry['Length'] = offset, len(data[-1])
+        index.append(entry)
+        offset += len(data[-1])
+
+    # Offsets are stored relative to the end of the header.
+    header = pickle.dumps({'Studyset': skeleton, 'Blocks': index})
+
+    with open(fname, 'wb') as fo:
+        fo.write(archive_prefix.pack(archive_magic, len(header)))
+        fo.write(header)
+        for d in data:
+            fo.write(d)
+
+
+def is_archive(fname):
+    with open(fname, 'rb') as fo:
+        return fo.read(len(archive_magic)) == archive_magic
+
+
+def file_range_reader(fname):
+    """
+    Return a function that reads a range of bytes from a local file.
+    """
+    def read_range(offset, length):
+        with open(fname, 'rb') as fo:
+            fo.seek(offset)
+            return fo.read(length)
+    return read_range
+
+
+def hatrac_range_reader(store, path):
+    """
+    Return a function that reads a range of bytes from an object in hatrac using HTTP range requests.
+    """
+    def read_range(offset, length):
+        r = store.get_obj(path, headers={'Range': 'bytes={0}-{1}'.format(offset, offset + length - 1)})
+        if r.status_code == 206:
+            return r.content
+        # Server ignored the range, so we got the whole object back.
+        return r.content[offset:offset + length]
+    return read_range
+
+
+def coalesce_ranges(blocks):
+    """
+    Group blocks into runs that are next to each other in the archive so they can be read with a single request.
+    :param blocks: list of block index entries
+    :return: list of (offset, length, [blocks])
+    """
+    runs = []
+    for b in sorted(blocks, key=lambda b: b['Offset']):
+        if runs and runs[-1][0] + runs[-1][1] == b['Offset']:
+            runs[-1][1] += b['Length']
+            runs[-1][2].append(b)
+        else:
+            runs.append([b['Offset'], b['Length'], [b]])
+    return runs
+
+
+def load_archive_block(read_range, block):
+    return block_value(np.load(io.BytesIO(read_range(block['Offset'], block['Length']))), block['Columns'])
+
+
+def read_archive(read_range, studies=None, types=None, radii=None, lazy=False):
+    """
+    Read a studyset from an indexed archive, only transferring the blocks that are selected by the filters.
+    :param read_range: function that takes an offset and length and returns those bytes from the archive.
+    :param studies: list of study IDs to read, or None for all of them
+    :param types: list of study types to read, or None for all of them
+    :param radii: list of radii to read, or None for all of them
+    :param lazy: If true, each block is read when it is first used rather than right away.
+    :return: the studyset
+    """
+    magic, length = archive_prefix.unpack(read_range(0, archive_prefix.size))
+    if magic != archive_magic:
+        raise ValueError('Not a studyset archive')
+    index = pickle.loads(read_range(archive_prefix.size, length))
+
+    # Prune the skeleton first, and then just fetch the blocks that are left.
+    sset = index['Studyset']
+    keep = [i for i, s in enumerate(sset['Studies']) if study_selected(s, studies, types)]
+    position = {i: n for n, i in enumerate(keep)}
+    if radii is not None:
+        # The skeleton records have no Data yet, so drop the ones for other radii here rather than in select_study.
+        for b in index['Blocks']:
+            if b['Kind'] == 'Record' and b['Study'] in position and b['Radius'] not in radii:
+                s = sset['Studies'][b['Study']]
+                s[b['DataType']] = {k: v for k, v in s[b['DataType']].items() if k != b['Radius']}
+    sset['Studies'] = [sset['Studies'][i] if radii is None else select_study(sset['Studies'][i], radii)
+                       for i in keep]
+    if 'Summary' in sset:
+        sset['Summary'] = filter_summary(sset['Summary'], studies, types, radii)
+
+    start = archive_prefix.size + length
+    blocks = []
+    for b in index['Blocks']:
+        if b['Study'] in position and (radii is None or b['Radius'] is None or b['Radius'] in radii):
+            b['Offset'] += start
+            blocks.append(b)
+
+    if lazy:
+        for b in blocks:
+            attach_block(sset['Studies'][position[b['Study']]], b,
+                         functools.partial(load_archive_block, read_range, b), lazy=True)
+    else:
+        for offset, length, run in coalesce_ranges(blocks):
+            buf = read_range(offset, length)
+            for b in run:
+                start = b['Offset'] - offset
+                value = block_value(np.load(io.BytesIO(buf[start:start + b['Length']])), b['Columns'])
+                attach_block(sset['Studies'][position[b['Study']]], b, lambda: value, lazy=False)
+
+    for s in sset['Studies']:
+        if 'Synapses' in s:
+            add_views(s)
+    return sset
+
+
+class Checkpoint(object):
+    """
+    A directory with a file for each study that has been paired, written as soon as the study is done, so that a long
+    computation can be resumed.  Each file records the provenance key of the study, which covers its source data and
+    the pairing parameters, and is only used again if the key has not changed.
+    """
+
+    def __init__(self, path, key):
+        """
+        :param path: the checkpoint directory, which is created if it does not exist.
+        :param key: function that returns the provenance key for a study, or None if the study can't be reused.
+        """
+        self.path = path
+        self.key = key
+        os.makedirs(path, mode=0o777, exist_ok=True)
+
+    def fname(self, s):
+        return os.path.join(self.path, '{0}.pkl'.format(s['Study']))
+
+    def save(self, s):
+        """
+        Save a paired study.  The file is written under a temporary name and then renamed, so an interrupted run
+        never leaves a partial checkpoint behind.
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, prefix='.checkpoint-')
+        try:
+            with os.fdopen(fd, 'wb') as fo:
+                pickle.dump({'Key': self.key(s), 'Study': remove_views(s)}, fo)
+            os.replace(tmpfile, self.fname(s))
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def load(self, s):
+        """
+        Get the saved copy of a study.
+        :return: the paired study, or None if it has not been saved or its provenance has changed.
+        """
+        key = self.key(s)
+        if key is None:
+            return None
+        try:
+            with open(self.fname(s), 'rb') as fo:
+                saved = pickle.load(fo)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if saved['Key'] != key:
+            return None
+        study = saved['Study']
+        if 'Synapses' in study:
+            add_views(study)
+        return study
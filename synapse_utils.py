@@ -1,19 +1,52 @@
 import os
 import subprocess
+import threading
+import functools
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import shutil
 import tempfile
+import numpy as np
 import pandas as pd
 import csv
 import pickle
 import synapse_plot_utils as sp
-from deriva.core import HatracStore, ErmrestCatalog, ErmrestSnapshot, get_credential, DerivaPathError
+import synapse_store
+import synapse_set
+import synapse_fetch
+import synapse_cache
+import synapse_pair
+import synapse_pipeline
+import synapse_csv
+from urllib.parse import unquote as urlunquote
+from deriva.core import HatracStore, ErmrestCatalog, ErmrestSnapshot, get_credential, DerivaPathError, urlquote
+from deriva.core import datapath, ermrest_model
 from bdbag import bdbag_api as bdb
-from synspy.analyze.pair import SynapticPairStudy, ImageGrossAlignment, transform_points, gross_points_swap
-import synspy.analyze.pair
+from synapse_set import transform_points
+
+# synspy is needed to retrieve, align and pair studies from the catalog, but not to pair them with the native engine
+# or to use studysets that have already been computed.
+try:
+    from synspy.analyze.pair import SynapticPairStudy, ImageGrossAlignment, gross_points_swap
+    import synspy.analyze.pair
+except ImportError:
+    synspy = None
 
 synapseserver = 'synapse.isrd.isi.edu'
-synspy.analyze.pair.gross_points_swap = True
-print('Setting gross points swap to {}'.format(synspy.analyze.pair.gross_points_swap))
+
+# Size of the HTTP connection pools for the shared catalog and object store clients.  The pool should be at least
+# as big as the number of worker threads that use a client.
+pool_connections = 4
+pool_maxsize = 16
+
+# Number of clients for catalog snapshots that are kept for each host.  A new snapshot is taken every time the catalog
+# changes, so the least recently used snapshot clients are dropped.
+snapshot_clients = 4
+if synspy is not None:
+    synspy.analyze.pair.gross_points_swap = True
+    print('Setting gross points swap to {}'.format(synspy.analyze.pair.gross_points_swap))
 
 # Configuring the logger for debug level will display the uri's generated by the api
 debug = False
@@ -51,6 +84,76 @@ def git_version():
     return GIT_REVISION
 
 
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def configure_pool(binding, connections=None, maxsize=None):
+    """
+    Resize the HTTP connection pools of a catalog or object store binding so that connections can be kept alive and
+    reused by several threads.
+    """
+    connections = connections or pool_connections
+    maxsize = maxsize or pool_maxsize
+    for adapter in set(binding._session.adapters.values()):
+        adapter._pool_connections, adapter._pool_maxsize = connections, maxsize
+        adapter.init_poolmanager(connections, maxsize)
+    return binding
+
+
+def get_client(key, factory, limit=None):
+    """
+    Return the client registered under key, creating it with factory the first time.  Clients are shared by every
+    entry point and thread in the process.
+    :param limit: If provided, only this many clients whose keys differ from key in just the last element are kept,
+                  dropping the least recently used.  Callers that still hold a dropped client can go on using it.
+    """
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = configure_pool(factory())
+        _clients.move_to_end(key)
+        client = _clients[key]
+        if limit is not None:
+            group = [k for k in _clients if k[:-1] == key[:-1]]
+            for k in group[:max(0, len(group) - limit)]:
+                del _clients[k]
+        return client
+
+
+def get_catalog(snaptime=None, host=None):
+    """
+    Get the shared catalog client for a host.
+    :param snaptime: If provided, the client is pinned to this catalog snapshot.
+    :param host: the server, which defaults to synapseserver
+    :return: an ErmrestCatalog or ErmrestSnapshot
+    """
+    host = host or synapseserver
+    if snaptime:
+        return get_client(('snapshot', host, snaptime),
+                          lambda: ErmrestSnapshot('https', host, 1, snaptime, credentials=get_credential(host)),
+                          limit=snapshot_clients)
+    return get_client(('catalog', host, None),
+                      lambda: ErmrestCatalog('https', host, 1, credentials=get_credential(host)))
+
+
+def get_latest_snapshot(host=None):
+    """
+    Get the shared catalog client for the most recent snapshot of the catalog.
+    """
+    # Read the snaptime with the shared client, rather than latest_snapshot, which makes a new binding every time.
+    r = get_catalog(host=host).get('/')
+    r.raise_for_status()
+    return get_catalog(r.json()['snaptime'], host)
+
+
+def get_objectstore(host=None):
+    """
+    Get the shared hatrac client for a host.
+    """
+    host = host or synapseserver
+    return get_client(('hatrac', host), lambda: HatracStore('https', host, credentials=get_credential(host)))
+
+
 def group_studies(studies, group='Type'):
     """
     Return a dictionary whose key is a type, subject, or alignment and whose value is a list of studies
@@ -67,14 +170,55 @@ def group_studies(studies, group='Type'):
     return g
 
 
+class SchemaCatalog(object):
+    """
+    A catalog whose model is built from a schema document that has already been retrieved, so that a path builder for
+    a snapshot does not have to read the schema again.  Everything else is passed on to the real catalog.
+    """
+
+    def __init__(self, catalog, schema):
+        self.catalog = catalog
+        self.schema = schema
+
+    def getCatalogModel(self):
+        return ermrest_model.Model(self.catalog, self.schema)
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+
+def path_builder(catalog):
+    """
+    Get the path builder for a catalog.  The schema of a catalog snapshot never changes, so it is kept in the query
+    cache.
+    """
+    snaptime = getattr(catalog, 'snaptime', None)
+    if not snaptime:
+        return catalog.getPathBuilder()
+    schema = synapse_cache.get_query_cache().get(snaptime, catalog.get_server_uri() + '/schema',
+                                                 catalog.getCatalogSchema)
+    return datapath.from_catalog(SchemaCatalog(catalog, schema))
+
+
+def cached_query(catalog, query):
+    """
+    Get the rows of a datapath query, only running it if it has not already been run against the catalog snapshot.
+    The rows are cached under the URI of the query, so a query that is changed, i.e. to add a column, is run again.
+    :param catalog: the catalog the query was built from
+    :param query: the result set of a query, i.e. path.entities(), which has not been fetched.
+    :return: list of rows
+    """
+    return synapse_cache.get_query_cache().get(getattr(catalog, 'snaptime', None), query.uri, lambda: list(query))
+
+
 def get_synapse_studies(catalog, studyset):
     """
     Retreave all of the entities that describe a studyset from an ERMRest catalog
     :param catalog: catalog with the study data
     :param studyset: The RID of the studyset we want to retrieve
-    :return:
+    :return: the result set of the query, which is fetched when it is first used.
     """
-    pb = catalog.getPathBuilder()
+    pb = path_builder(catalog)
 
     # convenient name for the schema we care about.
     zebrafish = pb.Zebrafish
@@ -122,25 +266,102 @@ def get_synapse_studies(catalog, studyset):
     return study_entities
 
 def versioned_studyid(studyid):
-    credential = get_credential(synapseserver)
     if '@' not in studyid:
-        ermrest_catalog = ErmrestCatalog('https', synapseserver, 1, credential).latest_snapshot()
+        ermrest_catalog = get_latest_snapshot()
         studyid = studyid + '@' + ermrest_catalog.snaptime
     return studyid
 
 
-def get_studies(studyid):
-    credential = get_credential(synapseserver)
+class PrefetchedResponse(object):
+    """
+    Minimal response object for rows that have already been retrieved.
+    """
+    status_code = 200
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def json(self):
+        return self.rows
+
+    def raise_for_status(self):
+        pass
+
+
+class ImageRowCatalog(object):
+    """
+    Wrap a catalog so that requests for a single Image row are answered from rows that were fetched in bulk.  This
+    lets ImageGrossAlignment.from_image_id build an alignment without a round trip for each image.  Any other
+    request is passed on to the real catalog, but it is recorded in misses and reported, so that a change in how
+    synspy asks for the row shows up rather than quietly costing a request for each study.
+    """
+    image_path = '/entity/Zebrafish:Image/ID='
+
+    def __init__(self, catalog, rows):
+        self.catalog = catalog
+        self.rows = rows
+        self.misses = []
+
+    def get(self, path, *args, **kwargs):
+        if path.startswith(self.image_path) and urlunquote(path[len(self.image_path):]) in self.rows:
+            return PrefetchedResponse([self.rows[urlunquote(path[len(self.image_path):])]])
+        self.misses.append(path)
+        print('Request was not answered from the prefetched image rows: {0}'.format(path))
+        return self.catalog.get(path, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+
+def get_image_rows(ermrest_catalog, image_ids, chunk=100):
+    """
+    Get the Image rows for a set of images.  Rows are cached by (image ID, snapshot), and any that are missing are
+    fetched with a single request for each chunk of IDs.
+    :param ermrest_catalog: catalog snapshot to get the images from
+    :param image_ids: list of image IDs
+    :param chunk: number of IDs to put into a single request
+    :return: dictionary mapping image ID to its row
+    """
+    cache = synapse_cache.get_query_cache()
+    snaptime = ermrest_catalog.snaptime
+    # Each row is cached under the URI of the query for that image on its own.
+    uri = ermrest_catalog.get_server_uri() + '/entity/Zebrafish:Image/ID={0}'
+    rows, missing = {}, []
+    for i in set(image_ids):
+        row = cache.lookup(snaptime, uri.format(urlquote(i)))
+        if row is None:
+            missing.append(i)
+        else:
+            rows[i] = row
+
+    for c in range(0, len(missing), chunk):
+        ids = missing[c:c + chunk]
+        r = ermrest_catalog.get('/entity/Zebrafish:Image/' + ';'.join('ID=' + urlquote(i) for i in ids))
+        r.raise_for_status()
+        for row in r.json():
+            rows[row['ID']] = row
+            cache.put(snaptime, uri.format(urlquote(row['ID'])), row)
+    return rows
+
+
+def list_studies(studyid):
+    """
+    Get the studies in a study set from the catalog, without computing their alignments.
+    :param studyid: RID of the study set, with an optional @snaptime suffix
+    :return: the studyset dictionary, and the catalog snapshot it was read from
+    """
     if '@' in studyid:
-        ermrest_catalog = ErmrestSnapshot('https', synapseserver, 1, credential)
+        [studyset, snaptime] = studyid.split('@')
+        ermrest_catalog = get_catalog(snaptime)
     else:
-        ermrest_catalog = ErmrestCatalog('https', synapseserver, 1, credential).latest_snapshot()
+        studyset = studyid
+        ermrest_catalog = get_latest_snapshot()
 
     githash = git_version()
     ermrest_snapshot = ermrest_catalog.snaptime
 
-    # Get the current list of studies from the server.
-    study_entities = get_synapse_studies(ermrest_catalog,studyid)
+    # Get the list of studies from the server, or from the query cache if we have already seen this snapshot.
+    study_entities = cached_query(ermrest_catalog, get_synapse_studies(ermrest_catalog, studyset))
 
     print('Identified %d studies' % len(study_entities))
 
@@ -153,7 +374,7 @@ def get_studies(studyid):
         'PrcDsy20171030B': 'interval-groundtruth-control'
     }
 
-    # Compute the alignment for each study, and fill in some useful values.
+    # Fill in some useful values.
     for i in study_entities:
         i['Paired'] = False
         if protocol_types[i['Protocol']] == 'aversion':
@@ -163,16 +384,36 @@ def get_studies(studyid):
                 i['Type'] = 'nonlearner'
         else:
             i['Type'] = protocol_types[i['Protocol']]
+        i['Aligned'] = False
+        i['Provenence'] = {'GITHash': githash, 'CatlogVersion': ermrest_snapshot}
+        i['StudyID'] = studyid
+
+    return {'StudyID': studyid,
+            'Studies': list(study_entities),
+            'Provenence': {'GITHash': githash, 'CatlogVersion': ermrest_snapshot}
+            }, ermrest_catalog
+
 
+def study_aligner(ermrest_catalog, study_entities):
+    """
+    Get ready to compute the alignments for a list of studies.  The image rows for all of the alignments are
+    retrieved with one request, and all of the alignment points are scaled from voxels to microns at once.
+    :param ermrest_catalog: catalog snapshot the studies come from
+    :param study_entities: list of studies
+    :return: a function that computes the alignment for one of the studies and returns the study.
+    """
+    image_catalog = ImageRowCatalog(ermrest_catalog, get_image_rows(ermrest_catalog,
+                                                                    [i['BeforeImageID'] for i in study_entities]))
+    align_pts = np.array([[[pt[c] if pt else np.nan for c in ['x', 'y', 'z']]
+                           for pt in [i['AlignP0'], i['AlignP1'], i['AlignP2']]] for i in study_entities],
+                         dtype=float).reshape((-1, 3, 3)) * [0.26, 0.26, 0.4]
+    align_pts = {i['Study']: align_pts[n] for n, i in enumerate(study_entities)}
+
+    def align(i):
         try:
             i['Aligned'] = False
-            i['Provenence'] = {'GITHash': githash, 'CatlogVersion': ermrest_snapshot}
-            i['StudyID'] = studyid
-            i['Alignment'] = ImageGrossAlignment.from_image_id(ermrest_catalog, i['BeforeImageID'])
-            p = pd.DataFrame([i[pt] for pt in ['AlignP0', 'AlignP1', 'AlignP2']])
-            p = p.multiply(pd.DataFrame([{'z': 0.4, 'y': 0.26, 'x': 0.26}]*3))
-
-            i['StudyAlignmentPts'] = pd.DataFrame(transform_points(i['Alignment'].M_canonical, p.loc[:,['x','y','z']]),
+            i['Alignment'] = ImageGrossAlignment.from_image_id(image_catalog, i['BeforeImageID'])
+            i['StudyAlignmentPts'] = pd.DataFrame(transform_points(i['Alignment'].M_canonical, align_pts[i['Study']]),
                                                   columns=['x', 'y', 'z'])
 #            i['StudyAlignmentPts'] = pd.DataFrame(transform_points(i['Alignment'].M, p.loc[:,['x','y','z']]),
 #                                                columns=['x', 'y', 'z'])
@@ -180,296 +421,574 @@ def get_studies(studyid):
             i['AlignmentPts'] = dict()
         except ValueError:  # Alignments missing....
             print('Alingment missing for study: {0}'.format(i['Study']))
-            continue
         except NotImplementedError:
             print('Alignment Code Failed for study: {0}'.format(i['Study']))
-            continue
+        return i
 
-    return {'StudyID': studyid,
-            'Studies': list(study_entities),
-            'Provenence': {'GITHash': githash, 'CatlogVersion': ermrest_snapshot}
-            }
+    return align
+
+
+def get_studies(studyid):
+    studyset, ermrest_catalog = list_studies(studyid)
+
+    # Compute the alignment for each study.
+    align = study_aligner(ermrest_catalog, studyset['Studies'])
+    for i in studyset['Studies']:
+        align(i)
+    return studyset
 
 
-def get_synapses(study):
+def get_synapses(study, workers=2, columns=synapse_csv.synapse_columns, savedir=None):
     """
     Get the synapse data associated with a study.  We will retrieve the actual data from the object store, and we will
-    get both the before and after data if it is availabe.  CSV version of the data will be read in and stored as a PANDA
+    get both the before and after data if it is availabe.  CSV version of the data will be parsed as it is retrieved
+    and stored as a PANDA
 
      study: a dictionary that has URLs for the two images, before and after
+     workers: number of files to retrieve at the same time
+     columns: list of columns to load as floats, or None for all of the columns
+     savedir: If given, a copy of each file without the metadata row is written into this directory at the same time.
      returns two pandas that have the synapses in them.
      """
-    credential = get_credential(synapseserver)
-    objectstore = HatracStore('https', synapseserver, credentials=credential)
+    objectstore = get_objectstore()
 
-    # Get a path for a tempory file to store HATRAC results
-    path = os.path.join(tempfile.mkdtemp(), 'image')
-    try:
-        # Get the before image from hatrac, be careful in case its missing
-        if study['BeforeURL']:
-            objectstore.get_obj(study['BeforeURL'], destfilename=path)
-            img1 = pd.read_csv(path)
-            if True: # Skip the second element, which has metadata in it....
-                img1.drop(img1.index[0], inplace=True)
-        else:
-            img1 = None
-
-        # Get the after image from hatrac, be careful in case its missing
-        if study['AfterURL']:
-            objectstore.get_obj(study['AfterURL'], destfilename=path)
-            img2 = pd.read_csv(path)
-            if True:
-                img2.drop(img2.index[0], inplace=True)
-        else:
-            img2 = None
-    finally:
-        shutil.rmtree(os.path.dirname(path))
-    return {'Before': img1, 'After': img2, 'Type': study['Type'], 'Study': study['Study'], 'Subject': study['Subject']}
+    def read(URL):
+        with synapse_cache.get_object_cache().open_obj(objectstore, URL) as source:
+            if savedir is None:
+                return synapse_csv.read_synapses(source, columns)
+            with open(os.path.join(savedir, os.path.basename(URL.split(':')[0])), 'wb') as tee:
+                return synapse_csv.read_synapses(source, columns, tee=tee)
+
+    # Get the before and after images from hatrac at the same time, be careful in case one is missing
+    urls = {i: study[i + 'URL'] for i in ['Before', 'After'] if study[i + 'URL']}
+    img = dict(zip(urls, synapse_fetch.concurrent_list(read, list(urls.values()), workers=workers)))
+    return {'Before': img.get('Before'), 'After': img.get('After'), 'Type': study['Type'], 'Study': study['Study'],
+            'Subject': study['Subject']}
 
 
-def copy_synapse_files(objectstore, study):
+def copy_synapse_file(objectstore, URL):
     """
-    Copy the files associated with a study into a local directory
+    Copy a single synapse file from hatrac into the synapse-data directory, dropping the metadata row.
     """
+    # Get the file name from the URL
+    hatracfilename = (os.path.basename(URL.split(':')[0]))
 
-    for URL in [study['BeforeURL'], study['AfterURL']]:
-        # Get a path for a tempory file to store HATRAC results
-        tmpfile = os.path.join(tempfile.mkdtemp(), 'image')
-        try:
+    # Stream the file from hatrac, or the local cache, to where it will end up....
+    with synapse_cache.get_object_cache().open_obj(objectstore, URL) as synapse:
+        with open('synapse-data/' + hatracfilename, 'wb') as outfile:
+            synapse_csv.copy_synapses(synapse, outfile)
 
-            # Create an output directory for synapse files.
-            os.makedirs('synapse-data', mode=0o777, exist_ok=True)
 
-            # Get the before image from hatrac, be careful in case its missing
-            if URL:
-                objectstore.get_obj(URL, destfilename=tmpfile)
+def copy_synapse_files(objectstore, study, workers=synapse_fetch.max_workers):
+    """
+    Copy the files associated with a study, or a list of studies, into a local directory.  The files are
+    downloaded concurrently.
+    """
+    studies = study if isinstance(study, list) else [study]
 
-                # Get the file name from the URL
-                hatracfilename = (os.path.basename(URL.split(':')[0]))
+    # Create an output directory for synapse files.
+    os.makedirs('synapse-data', mode=0o777, exist_ok=True)
 
-                # Now copy the file from the tmp directory to where it will end up....
-                with open(tmpfile) as synapse:
-                    with open('synapse-data/' + hatracfilename, 'w') as outfile:
-                        # Write header
-                        outfile.write(synapse.readline())
+    # Be careful in case the before or after image is missing
+    urls = [URL for s in studies for URL in [s['BeforeURL'], s['AfterURL']] if URL]
+    synapse_fetch.concurrent_list(lambda URL: copy_synapse_file(objectstore, URL), urls, workers=workers)
 
-                        # Skip second line
-                        f = synapse.readline()
-                        if 'saved,parameters' not in f:
-                            outfile.write(f)
 
-                        # now copy the rest of the file...
-                        for f in synapse:
-                            outfile.write(f)
-        finally:
-            shutil.rmtree(os.path.dirname(tmpfile))
+def retrieve_study(s):
+    """
+    Get the synaptic pair study for a study and retrieve its data from the object store.
+    """
+    study = SynapticPairStudy.from_study_id(get_catalog(), s['Study'])
+    study.retrieve_data(get_objectstore())
+    return study
+
+
+def study_summary(s):
+    """
+    Build the summary table for a paired study, with a row for each datatype, radius and alignment.
+    """
+    summary = s['Synapses'].summary()
+    summary.insert(0, 'Type', s['Type'])
+    summary.insert(0, 'Study', s['Study'])
+    return summary
 
 
-def compute_pairs(studylist, radii, ratio=None, maxratio=None):
+def summarize_studies(studylist):
+    """
+    Combine the summaries of a list of studies into a single table.  Studies that were paired before summaries were
+    kept are summarized from their synapses.
+    :param studylist: list of paired studies
+    :return: DataFrame with a row for each study, datatype, radius and alignment.
+    """
+    summaries = [s['Summary'] if 'Summary' in s else study_summary(s) for s in studylist if 'Synapses' in s]
+    if not summaries:
+        return pd.DataFrame(columns=['Study', 'Type'] + synapse_set.summary_columns)
+    return pd.concat(summaries, ignore_index=True)
+
+
+def set_synapses(s, synapses):
+    """
+    Store a SynapseSet in a study along with the views of it for each datatype and radius, and a summary of the
+    synapses for each of them.
+    """
+    s['Synapses'] = synapses
+    synapse_set.add_views(s)
+    s['Summary'] = study_summary(s)
+    if s['Aligned']:
+        s['AlignmentPts'] = {r: {'Data': s['StudyAlignmentPts']} for r in synapses.radii}
+    return s
+
+
+def pair_study(s, study, radii, ratio=None, maxratio=None, float32=False, engine='synspy'):
+    """
+    Compute the pairs for a study whose data has been retrieved, and store them in the study.
+    :param s: the study dictionary
+    :param study: the SynapticPairStudy with the data for the study
+    :param engine: synspy to use syn_pairing_maps, or native to use synapse_pair.pair_synapses
+    :return: the study dictionary
+    """
+    # Keep the before and after synapses once, along with the partners of each synapse.  The paired and unpaired
+    # sets for each radius, and their aligned versions, are views over these arrays.
+    transform = s['Alignment'].M_canonical if s['Aligned'] else None
+    if engine == 'native':
+        # Mutual nearest neighbour pairs at a smaller distance are the ones whose match distance is within it, so
+        # only pair at the largest distance.
+        s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(study.s1, study.s2, max(radii), ratio, maxratio)
+        synapses = synapse_set.SynapseSet.from_pairing(study.s1, study.s2, radii, s1_to_s2, s2_to_s1, distance,
+                                                       transform=transform, float32=float32)
+    elif engine == 'synspy':
+        # synspy pairs greedily, so the pairs at a smaller distance are not a subset of the ones at the largest
+        # distance, and each radius has to be paired.
+        s1_to_s2, s2_to_s1 = study.syn_pairing_maps(radii, ratio, maxratio)
+        synapses = synapse_set.SynapseSet.from_pairing_maps(study.s1, study.s2, radii, s1_to_s2, s2_to_s1,
+                                                            transform=transform, float32=float32)
+    else:
+        raise ValueError('Unknown pairing engine {0}'.format(engine))
+    return set_synapses(s, synapses)
+
+
+def process_study(s, radii, ratio=None, maxratio=None, float32=False, engine='synspy'):
+    """
+    Retrieve and pair a single study in a worker process.  The retrieval is retried the same as in the other modes.
+    Errors are returned rather than raised so that one study can't abort the rest of the batch.
+    :return: (study, error)
+    """
+    try:
+        study = synapse_fetch.with_retries(retrieve_study, s, fatal=(DerivaPathError,), label=s['Study'])
+        return pair_study(s, study, radii, ratio, maxratio, float32, engine), None
+    except Exception as e:
+        return s, e
+
+
+def reset_clients():
+    """
+    Forget the shared clients, so a worker process does not use connections that belong to its parent.
+    """
+    with _clients_lock:
+        _clients.clear()
+
+
+def paired_studies(studylist, radii, ratio, maxratio, float32, engine, download_workers, workers):
+    """
+    Generate (study, paired study, error) for each study in order, either pairing in this process while the data
+    for the following studies is retrieved, or farming each study out to a pool of processes.
+    """
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers, initializer=reset_clients) as pool:
+            f = functools.partial(process_study, radii=radii, ratio=ratio, maxratio=maxratio, float32=float32,
+                                  engine=engine)
+            for s, (paired, error) in zip(studylist, pool.map(f, studylist)):
+                yield s, paired, error
+    else:
+        for s, study, error in synapse_fetch.concurrent_map(retrieve_study, studylist, workers=download_workers,
+                                                            fatal=(DerivaPathError,), label=lambda s: s['Study']):
+            paired = None
+            if error is None:
+                try:
+                    paired = pair_study(s, study, radii, ratio, maxratio, float32, engine)
+                except Exception as e:
+                    error = e
+            yield s, paired, error
+
+
+def compute_pairs(studylist, radii, ratio=None, maxratio=None, float32=False,
+                  download_workers=synapse_fetch.max_workers, workers=None, engine='synspy',
+                  checkpoint=None, resume=False, previous=None):
+    """
+    Compute the synapse pairs for each study in a list.  Each study gets a SynapseSet in s['Synapses'] along with
+    views so that s['PairedBefore'][r]['Data'] and the other datatypes work as before.  Studies that fail are
+    reported and left out of the result.
+    :param studylist: list of studies
+    :param radii: radii over which pairs should be computed
+    :param ratio: intensity weighting used by the pairing, or None
+    :param maxratio: maximum intensity ratio for a pair, or None
+    :param float32: store the synapse arrays as float32 to save memory
+    :param download_workers: number of studies whose data is retrieved at the same time
+    :param workers: If given, retrieve and pair the studies in a pool with this many processes.
+    :param engine: synspy to pair with synspy, or native to use the mutual nearest neighbour pairing in synapse_pair.
+    :param checkpoint: directory where each study is saved as soon as it has been paired.
+    :param resume: If true, studies that are already in the checkpoint with the same provenance are not paired again.
+    :param previous: a studyset computed earlier.  Studies whose provenance key has not changed are copied from it.
+    :return: the list of studies that have been paired, in the same order as studylist.
+    """
     print('Finding pairs for {0} studies'.format(len(studylist)))
 
-    credential = get_credential(synapseserver)
-    ermrest_catalog = ErmrestCatalog('https', synapseserver, 1, credential)
-    hatrac_store = HatracStore('https', synapseserver, credentials=credential)
+    return memoized_pairs(
+        studylist,
+        lambda todo: paired_studies(todo, radii, ratio, maxratio, float32, engine, download_workers, workers),
+        pairing_parameters(radii, ratio, maxratio, float32, engine), checkpoint, resume, previous)
 
-    pairlist = []
+
+def pairing_parameters(radii, ratio=None, maxratio=None, float32=False, engine='synspy'):
+    """
+    The parameters and code version that determine the pairs for a study.
+    """
+    return {'Radii': sorted(radii), 'Ratio': ratio, 'MaxRatio': maxratio, 'Float32': float32, 'Engine': engine,
+            'GITHash': git_version()}
+
+
+def study_key(s, parameters):
+    """
+    Compute the provenance key for the pairs of a study.  The key covers the versioned URLs of the before and after
+    synapses, the image and points used for the alignment, and the pairing parameters.  Two studies with the same key
+    will have the same pairs.
+    :param s: the study
+    :param parameters: the pairing parameters, from pairing_parameters
+    :return: the key, or None if the synapse URLs are not versioned, as then the data could change under the same key.
+    """
+    urls = [s.get('BeforeURL'), s.get('AfterURL')]
+    if not all(u and synapse_cache.versioned(u) for u in urls):
+        return None
+    source = {k: s.get(k) for k in ['BeforeURL', 'AfterURL', 'BeforeImageID', 'AlignP0', 'AlignP1', 'AlignP2']}
+    return hashlib.sha256(json.dumps([source, parameters], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def has_radii(s, radii):
+    """
+    Check that a paired study has the pairs and summary for each of a list of radii.  A study that was narrowed with
+    filter_studyset or fetch_studies(..., radii=...) keeps its pairing key, but not the other radii.
+    """
+    if 'Synapses' not in s or not set(radii) <= set(s['Synapses'].radii):
+        return False
+    return 'Summary' not in s or set(radii) <= set(s['Summary']['Radius'])
+
+
+def memoized_pairs(studylist, pair, parameters, checkpoint=None, resume=False, previous=None):
+    """
+    Pair a list of studies, reusing the pairs from a previous studyset or a checkpoint for the studies whose
+    provenance key has not changed and that still have all of the radii.  Each study that is paired is saved to the
+    checkpoint directory as soon as it is done.
+    :param studylist: list of studies
+    :param pair: function that takes a list of studies and generates (study, paired study, error) for each of them.
+    :param parameters: the pairing parameters, from pairing_parameters
+    :param checkpoint: the checkpoint directory, or None to not save the studies.
+    :param resume: If true, use the studies that are already in the checkpoint rather than pairing them again.
+    :param previous: a studyset computed earlier, whose studies are used if their key matches.
+    :return: list of the paired studies in the same order as studylist.
+    """
+    key = functools.partial(study_key, parameters=parameters)
+    saved = synapse_store.Checkpoint(checkpoint, key) if checkpoint else None
+    memo = {p['Study']: p for p in previous['Studies']} if previous else {}
+
+    reused = set()
     for s in studylist:
+        provenence = dict(s.get('Provenence', {}), PairingKey=key(s))
+        s['Provenence'] = provenence
+        if provenence['PairingKey'] is None:
+            continue
+        study = memo.get(s['Study'])
+        if (study is not None and study.get('Provenence', {}).get('PairingKey') == provenence['PairingKey'] and
+                has_radii(study, parameters['Radii'])):
+            study = synapse_set.remove_views(study)
+        elif resume and saved:
+            study = saved.load(s)
+        else:
+            study = None
+        if study is not None and has_radii(study, parameters['Radii']):
+            s.update(study)
+            s['Provenence'] = provenence
+            if 'Synapses' in s:
+                synapse_set.add_views(s)
+            reused.add(s['Study'])
+    if previous or resume:
+        print('Reusing {0} of {1} studies that are already paired'.format(len(reused), len(studylist)))
+
+    paired = {s['Study'] for s in collect_pairs(pair([s for s in studylist if s['Study'] not in reused]),
+                                                save=saved.save if saved else None)}
+    return [s for s in studylist if s['Study'] in reused or s['Study'] in paired]
+
+
+def collect_pairs(results, save=None):
+    """
+    Gather the studies that were paired, reporting the ones that failed.
+    :param results: iterable of (study, paired study, error) in the order of the studies
+    :param save: function called with each study as soon as it has been paired.
+    :return: list of the paired studies
+    """
+    pairlist = []
+    for s, paired, error in results:
         syn_study_id = s['Study']
         s['Paired'] = True
 
         print('Processing study {0}'.format(syn_study_id))
-        study = SynapticPairStudy.from_study_id(ermrest_catalog, syn_study_id)
-        try:
-            study.retrieve_data(hatrac_store)
-        except DerivaPathError:
+        if isinstance(error, DerivaPathError):
             print('Study {0} missing synaptic pair'.format(syn_study_id))
             continue
+        elif error is not None:
+            print('Study {0} failed: {1}'.format(syn_study_id, error))
+            continue
+
+        # Results from a worker process are copies, so put them back into the original study.
+        if paired is not s:
+            s.update(paired)
+        if save is not None:
+            save(s)
         pairlist.append(s)
+    return pairlist
 
-        # Compute the actual pairs for the given distances
-        s1_to_s2, s2_to_s1 = study.syn_pairing_maps(radii, ratio, maxratio)
 
-        # get results for different radii, store them in a dictonary of pandas
-        for i, r in enumerate(radii):
-
-            unpaired1 = study.get_unpaired(s1_to_s2[i, :], study.s1)
-            unpaired2 = study.get_unpaired(s2_to_s1[i, :], study.s2)
-            paired1, paired2 = study.get_pairs(s1_to_s2[i, :], study.s1, study.s2)
-
-            p = pd.DataFrame(unpaired1[:, 0:5], columns=['z', 'y', 'x', 'core', 'hollow'])
-            s['UnpairedBefore'] = s.get('UnpairedBefore', dict())
-            s['UnpairedBefore'][r] = {'Data': p}
-
-            p = pd.DataFrame(unpaired2[:, 0:5], columns=['z', 'y', 'x', 'core', 'hollow'])
-            s['UnpairedAfter'] = s.get('UnpairedAfter', dict())
-            s['UnpairedAfter'][r] = {'Data': p}
-
-            p = pd.DataFrame(paired1[:, 0:5], columns=['z', 'y', 'x', 'core', 'hollow'])
-            s['PairedBefore'] = s.get('PairedBefore', dict())
-            s['PairedBefore'][r] = {'Data': p}
-
-            p = pd.DataFrame(paired2[:, 0:5], columns=['z', 'y', 'x', 'core', 'hollow'])
-            s['PairedAfter'] = s.get('PairedAfter', dict())
-            s['PairedAfter'][r] = {'Data': p}
-
-            # Fill in other useful values so you can use them without having the study handy
-            for ptype in ['PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter']:
-                p = s[ptype][r]
-                p['DataType'] = ptype
-                p['Study'] = s['Study']
-                p['Radius'] = r
-                p['Type'] = s['Type']
-
-            # now compute the centroids and store as pandas.
-            for ptype in ['PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter']:
-                p = s[ptype][r]['Data']
-                centroid = tuple([p['x'].mean(), p['y'].mean(), p['z'].mean()])
-                pc = pd.DataFrame.from_records([centroid], columns=['x', 'y', 'z'])
-                cname = ptype + 'Centroid'
-                s[cname] = s.get(cname, dict())
-                s[cname][r] = {'Data': pc}
-                p = s[cname][r]
-                p['DataType'] = cname
-                p['Study'] = s['Study']
-                p['Radius'] = r
-                p['Type'] = s['Type']
-
-            # Now compute the aligned images, if you have the tranformation matrix available.
-            if s['Aligned']:
-                image_obj = s['Alignment']
-                s['AlignmentPts'][r] = {'Data': s['StudyAlignmentPts']}
-                for ptype in ['PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter']:
-                    p = pd.DataFrame(transform_points(image_obj.M_canonical, s[ptype][r]['Data'].loc[:, ['x', 'y', 'z']]),
-                                     columns=['x', 'y', 'z'])
-                    p['core'] = s[ptype][r]['Data']['core']
-
-                    # Now do th aligned ....
-                    datatype = 'Aligned' + ptype
-                    s[datatype] = s.get(datatype, dict())
-                    s[datatype][r] = {'Data': p}
-                    s[datatype][r]['DataType'] = datatype
-                    s[datatype][r]['Study'] = s['Study']
-                    s[datatype][r]['Radius'] = r
-                    s[datatype][r]['Type'] = s['Type']
-
-                    # now compute the aligned centroids and store as pandas.
-                    centroid = tuple([p['x'].mean(), p['y'].mean(), p['z'].mean()])
-                    pc = pd.DataFrame.from_records([centroid], columns=['x', 'y', 'z'])
-                    pc = pd.DataFrame.from_records([centroid], columns=['x', 'y', 'z'])
-                    cname = datatype + 'Centroid'
-                    s[cname] = s.get(cname, dict())
-                    s[cname][r] = {'Data': pc}
-                    s[cname]['DataType'] = cname
-                    s[cname]['Study'] = s['Study']
-                    s[cname]['Radius'] = r
-                    s[cname]['Type'] = s['Type']
+def recompute_pairs(studylist, radii, ratio=None, maxratio=None):
+    """
+    Pair studies again with different parameters, using the synapses that they already hold rather than retrieving
+    them from the catalog.  This always uses the native pairing engine.
+    :param studylist: list of studies that have been paired
+    :param radii: radii over which pairs should be computed
+    :param ratio: intensity weighting used by the pairing, or None
+    :param maxratio: maximum intensity ratio for a pair, or None
+    :return: a list of new studies with the new pairs.  The synapse arrays are shared with the original studies.
+    """
+    parameters = pairing_parameters(radii, ratio, maxratio, engine='native')
+    pairlist = []
+    for s in studylist:
+        synapses = s['Synapses']
+        before, after = synapses.arrays[('Before', None)], synapses.arrays[('After', None)]
+        s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(before, after, max(radii), ratio, maxratio)
+        paired = synapse_set.SynapseSet.from_pairing(before, after, radii, s1_to_s2, s2_to_s1, distance=distance,
+                                                     transform=synapses.transform)
+        # The point clouds are the same, so their aligned versions can be shared too.
+        paired.aligned_arrays = synapses.aligned_arrays
+        p = set_synapses(synapse_set.remove_views(s), paired)
+        # The pairs no longer come from the parameters in the pairing key, so derive a new key from it.
+        key = p.get('Provenence', {}).get('PairingKey')
+        if key:
+            key = hashlib.sha256(json.dumps([key, parameters], sort_keys=True).encode('utf-8')).hexdigest()
+            p['Provenence'] = dict(p['Provenence'], PairingKey=key)
+        pairlist.append(p)
     return pairlist
 
 
-def compute_studies(studyid, syn_pair_radii):
+def pairing_rates(studylist, radii):
+    """
+    Tabulate how the fraction of paired synapses changes with the pairing radius for each study.
+    :param studylist: list of studies that have been paired
+    :param radii: list of radii, up to the largest radius used when the studies were paired.  Studies paired by
+                  synspy only have the pairs for the radii they were paired at.
+    :return: DataFrame with a row for each study and radius
+    """
+    rates = []
+    for s in studylist:
+        rate = s['Synapses'].pairing_rate(radii)
+        rate.insert(0, 'Type', s['Type'])
+        rate.insert(0, 'Study', s['Study'])
+        rates.append(rate)
+    return pd.concat(rates, ignore_index=True)
+
+
+# Default number of threads for each stage of the compute_studies pipeline.
+stage_workers = {'align': 1, 'download': 4, 'pair': 1}
+
+
+def pipeline_pairs(studylist, align, radii, ratio=None, maxratio=None, float32=False, engine='synspy',
+                   workers=None, queue_size=synapse_pipeline.queue_size):
+    """
+    Align, retrieve and pair studies as a pipeline, so that the data for one study is being retrieved while the
+    previous one is paired and the next one is aligned.
+    :param studylist: list of studies
+    :param align: function that computes the alignment for a study
+    :param workers: dictionary with the number of threads for the align, download and pair stages, any that are
+                    missing come from stage_workers.
+    :param queue_size: number of studies that can wait between two stages.
+    :return: generator of (study, paired study, error) in the order of studylist.
+    """
+    workers = dict(stage_workers, **(workers or {}))
+
+    def download(s):
+        return s, synapse_fetch.with_retries(retrieve_study, s, fatal=(DerivaPathError,), label=s['Study'])
+
+    def pair(task):
+        return pair_study(task[0], task[1], radii, ratio, maxratio, float32, engine)
+
+    return synapse_pipeline.run_pipeline(studylist, [synapse_pipeline.Stage('align', align, workers['align']),
+                                                     synapse_pipeline.Stage('download', download, workers['download']),
+                                                     synapse_pipeline.Stage('pair', pair, workers['pair'])],
+                                         queue_size=queue_size)
+
+
+def compute_studies(studyid, syn_pair_radii, float32=False, workers=None, engine='synspy', pipeline=False,
+                    stage_workers=None, checkpoint=None, resume=False, previous=None):
     """
     Compute the study pairs and build a python datastructure with all the pairs.  Result is a dictionary
     :param studyid: RID of the study cohort on which the pairs should be computed
     :param syn_pair_radii: tuple of radi over which pairs should be computed.
+    :param float32: store the synapse arrays as float32 to save memory
+    :param workers: number of processes to use to compute the pairs, or None to compute them in this process.
+    :param engine: pairing engine to use, synspy or native
+    :param pipeline: If true, align, retrieve and pair the studies in overlapping stages rather than one after the
+                     other.
+    :param stage_workers: dictionary with the number of threads for the align, download and pair stages of the
+                          pipeline.
+    :param checkpoint: directory where each study is saved as soon as it has been paired.
+    :param resume: If true, studies that are already in the checkpoint with the same provenance are not paired again.
+    :param previous: a studyset computed earlier, i.e. from fetch_studies.  Only the studies whose source data or
+                     parameters have changed are paired again.
     :return:
     """
-    studyset = get_studies(studyid)
+    if pipeline:
+        studyset, ermrest_catalog = list_studies(studyid)
+        align = study_aligner(ermrest_catalog, studyset['Studies'])
+    else:
+        studyset = get_studies(studyid)
     for k, v in group_studies(studyset['Studies'], group='Type').items():
         print('{0} {1}'.format(k, len(v)))
-    studyset['Studies'] = compute_pairs(studyset['Studies'], syn_pair_radii)
+    if pipeline:
+        print('Finding pairs for {0} studies'.format(len(studyset['Studies'])))
+        studyset['Studies'] = memoized_pairs(
+            studyset['Studies'],
+            lambda todo: pipeline_pairs(todo, align, syn_pair_radii, float32=float32, engine=engine,
+                                        workers=stage_workers),
+            pairing_parameters(syn_pair_radii, float32=float32, engine=engine), checkpoint, resume, previous)
+    else:
+        studyset['Studies'] = compute_pairs(studyset['Studies'], syn_pair_radii, float32=float32, workers=workers,
+                                            engine=engine, checkpoint=checkpoint, resume=resume, previous=previous)
+    studyset['Summary'] = summarize_studies(studyset['Studies'])
     return studyset
 
 
-def upload_studies(studyid, syn_pair_radii, description = False):
+def upload_studies(studyid, syn_pair_radii, description = False, format='pickle', workers=None, pipeline=False,
+                   checkpoint=None, resume=False, previous=None):
     """
     Compute the study pairs, dump out the python structure, upload to hatrac and link in as a data file associated
     with the study set.
     :param studyid: RID of the study cohort on which the pairs should be computed
     :param syn_pair_radii: tuple of radi over which pairs should be computed.
+    :param format: pickle, or archive to upload an indexed file that fetch_studies can partially retrieve.
+    :param workers: number of processes to use to compute the pairs, or None to compute them in this process.
+    :param pipeline: If true, align, retrieve and pair the studies in overlapping stages.
+    :param checkpoint: directory where each study is saved as soon as it has been paired.
+    :param resume: If true, studies that are already in the checkpoint with the same provenance are not paired again.
+    :param previous: a studyset computed earlier, whose studies are reused if their provenance has not changed.
     :return:
     """
     if not description:
         description = 'Python data structures with pair data for {0}'.format(studyid)
-    studyset = compute_studies(studyid, syn_pair_radii)
+    studyset = compute_studies(studyid, syn_pair_radii, workers=workers, pipeline=pipeline, checkpoint=checkpoint,
+                               resume=resume, previous=previous)
 
     # Get a path for a temporary file to store  results
-    tmpfile = os.path.join(tempfile.mkdtemp(), 'pairs-dump.pkl')
+    tmpfile = os.path.join(tempfile.mkdtemp(), 'pairs-dump' + ('.sset' if format == 'archive' else '.pkl'))
     try:
-        with open(tmpfile, 'wb') as fo:
-            pickle.dump(studyset, fo)
-            print('dumped {0} studies to {1}'.format(len(studyset['Studies']), tmpfile))
-
+        dump_studies(studyset, tmpfile, format=format)
         add_file_to_cohort(tmpfile, description, studyid)
     finally:
         shutil.rmtree(os.path.dirname(tmpfile))
     return
 
 
-def dump_studies(sset, fname):
-    with open(fname, 'wb') as fo:
-        pickle.dump(sset, fo)
-        print('dumped {0} studies to {1}'.format(len(sset['Studies']), fname))
+def dump_studies(sset, fname, format='pickle'):
+    """
+    Save a study set to a file.
+    :param sset: the study set to save
+    :param fname: name of the file, or directory for the columnar format
+    :param format: pickle, columnar to write a directory with one .npy block per study, datatype and radius, or
+                   archive to write a single file with an index of the blocks that can be partially read.
+    :return: None
+    """
+    if format == 'columnar':
+        synapse_store.dump_columnar(sset, fname)
+    elif format == 'archive':
+        synapse_store.dump_archive(sset, fname)
+    else:
+        with open(fname, 'wb') as fo:
+            pickle.dump(sset, fo)
+    print('dumped {0} studies to {1}'.format(len(sset['Studies']), fname))
 
 
-def fetch_studies(fileid):
+def fetch_studies(fileid, studies=None, types=None, radii=None):
     """
-    Get the set of files associated with a cohort analysis.
+    Get the set of files associated with a cohort analysis.  If the file was uploaded as an archive, only the parts
+    selected by the filters are retrieved, using HTTP range requests.  Complete files are kept in the local object
+    cache, so fetching the same file again does not download it.
     :param fileid: RID of the saved analysis data.
+    :param studies: list of study IDs to retrieve, or None for all of them.
+    :param types: list of study types (learner, nonlearner, ...) to retrieve, or None for all of them.
+    :param radii: list of pairing radii to retrieve, or None for all of them.
     :return: None.
     """
 
-    credential = get_credential(synapseserver)
-
     if '@' in fileid:
         [fileid, snaptime] = fileid.split('@')
-        catalog = ErmrestSnapshot('https', synapseserver, 1, snaptime, credentials=credential)
+        catalog = get_catalog(snaptime)
     else:
-        catalog = ErmrestCatalog('https', synapseserver, 1, credentials=credential)
-        catalog = catalog.latest_snapshot()
+        catalog = get_latest_snapshot()
         snaptime = catalog.snaptime
-    hatrac = HatracStore('https', synapseserver, credentials=credential)
+    hatrac = get_objectstore()
 
-    pb = catalog.getPathBuilder()
+    pb = path_builder(catalog)
     zebrafish = pb.Zebrafish
     synapse = pb.Synapse
 
     # Lets get some shortcuts for awkward table names.
-    cohort_table = zebrafish.tables['Cohort Analysis']
     collection_table = zebrafish.tables['Cohort Analysis_Collection']
     collection = synapse.tables['Collection']
 
-    # Now get the studyid associated with this file....
-
-    studyid = collection.filter(collection.RID == fileid).link(collection_table).entities()[0]['Cohort Analysis']
-
-    path = cohort_table.alias('studyset').link(zebrafish.tables['Cohort Analysis_Collection']).link(collection)
-    path = path.filter(path.studyset.RID == studyid)
-
-    fileentity = collection.filter(collection.RID == fileid).entities()[0]
+    # Now get the studyid associated with this file.  Results from a snapshot never change, so use the query cache.
+    studyid = cached_query(catalog, collection.filter(collection.RID == fileid).link(collection_table).entities())
+    studyid = studyid[0]['Cohort Analysis']
+    fileentity = cached_query(catalog, collection.filter(collection.RID == fileid).entities())[0]
     file = fileentity['URL']
     print('File description: {}'.format(fileentity['Description']))
 
-    try:
-        # Get a path for a temporary file to store  results
-        tmpfile = os.path.join(tempfile.mkdtemp(), 'pairs-dump.pkl')
-        hatrac.get_obj(file, destfilename=tmpfile)
-        with open(tmpfile, 'rb') as fo:
-            slist = pickle.load(fo)
-    finally:
-        shutil.rmtree(os.path.dirname(tmpfile))
+    cache = synapse_cache.get_object_cache()
+    md5 = fileentity.get('MD5')
+    filtered = studies is not None or types is not None or radii is not None
+    if file.split(':')[0].endswith('.sset') and filtered and not cache.lookup(file, md5):
+        # Just get the parts of the archive that we need.
+        slist = synapse_store.read_archive(synapse_store.hatrac_range_reader(hatrac, file),
+                                           studies=studies, types=types, radii=radii)
+    else:
+        # Get a path for a temporary file to store results if the file is not in the cache
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tmpfile = cache.get_obj(hatrac, file, destfilename=os.path.join(tmpdir, 'pairs-dump'), md5=md5)
+            if synapse_store.is_archive(tmpfile):
+                slist = synapse_store.read_archive(synapse_store.file_range_reader(tmpfile),
+                                                   studies=studies, types=types, radii=radii)
+            else:
+                with open(tmpfile, 'rb') as fo:
+                    slist = pickle.load(fo)
+                slist = synapse_store.filter_studyset(slist, studies=studies, types=types, radii=radii)
+        finally:
+            shutil.rmtree(tmpdir)
 
     print('Restored {0} studies from {1}'.format(len(slist['Studies']),studyid))
     return studyid, slist
 
 
-def restore_studies(fname):
+def restore_studies(fname, lazy=False):
     """
     Restore a picked study set from a file.
-    :param fname: name of file which contrains the pickled data.
+    :param fname: name of file which contrains the pickled data, a directory written in the columnar format or an
+                  archive file.
+    :param lazy: For the columnar and archive formats, only read the point data for a study when it is first used.
     :return: the list of studies.
     """
-    with open(fname, 'rb') as fo:
-        slist = pickle.load(fo)
+    if os.path.isdir(fname):
+        slist = synapse_store.restore_columnar(fname, lazy=lazy)
+    elif synapse_store.is_archive(fname):
+        slist = synapse_store.read_archive(synapse_store.file_range_reader(fname), lazy=lazy)
+    else:
+        with open(fname, 'rb') as fo:
+            slist = pickle.load(fo)
 
     print('Restored {0} studies'.format(len(slist['Studies'])))
     return slist
@@ -485,16 +1004,15 @@ def copy_cohort(studyset, description=''):
 
     # Need to use Deriva authentication agent before executing this
 
-    credential = get_credential(synapseserver)
     if '@' in studyset:
         [studyset, version] = studyset.split('@')
-        catalog = ErmrestSnapshot('https', synapseserver, 1, version, credentials=credential)
+        catalog = get_catalog(version)
     else:
-        catalog = ErmrestCatalog('https', synapseserver, 1, credentials=credential).latest_snapshot()
+        catalog = get_latest_snapshot()
 
     systemcolumns = ['RMT', 'RID', 'RCT', 'RCB', 'RMB']
 
-    pb = catalog.getPathBuilder()
+    pb = path_builder(catalog)
     # convenient name for the schema and tables we care about.
     zebrafish = pb.Zebrafish
     cohort_table = zebrafish.tables['Cohort Analysis']
@@ -504,12 +1022,13 @@ def copy_cohort(studyset, description=''):
     path = cohort_table.alias('studyset').link(pair_table)
     path = path.filter(path.studyset.RID == studyset)
 
-    cohort = path.studyset.entities()[0]
-    pairs = path.entities()
-    files = path.studyset.link(collection_table).entities()
+    # Results from a snapshot never change, so use the query cache.
+    cohort = cached_query(catalog, path.studyset.entities())[0]
+    pairs = cached_query(catalog, path.entities())
+    files = cached_query(catalog, path.studyset.link(collection_table).entities())
 
     # Now switch to the current catalog
-    catalog = ErmrestCatalog('https', synapseserver, 1, credentials=credential)
+    catalog = get_catalog()
     pb = catalog.getPathBuilder()
     zebrafish = pb.Zebrafish
     cohort_table = zebrafish.tables['Cohort Analysis']
@@ -554,9 +1073,8 @@ def add_file_to_cohort(file, description, cohort):
     :param cohort: RID of the analysis cohort to which the file file should be assoicated.
     :return: None.
     """
-    credential = get_credential(synapseserver)
-    store = HatracStore('https', synapseserver, credentials=credential)
-    catalog = ErmrestCatalog('https', synapseserver, 1, credentials=credential)
+    store = get_objectstore()
+    catalog = get_catalog()
 
     pb = catalog.getPathBuilder()
     zebrafish = pb.Zebrafish
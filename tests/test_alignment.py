@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('synspy')
+import synapse_cache
+import synapse_utils
+from synspy.analyze.pair import ImageGrossAlignment
+
+
+class Response(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.rows
+
+
+def image_row(image_id):
+    return {'ID': image_id, 'RID': image_id,
+            'Align P0 ZYX': {'z': 10.0, 'y': 200.0, 'x': 300.0},
+            'Align P1 ZYX': {'z': 12.0, 'y': 260.0, 'x': 310.0},
+            'Align P2 ZYX': {'z': 11.0, 'y': 210.0, 'x': 380.0}}
+
+
+class Snapshot(object):
+    """
+    Stands in for an ErmrestSnapshot, answering bulk Image queries and recording the requests that are made to it.
+    """
+    snaptime = '2PM-DGYP-56Z4'
+
+    def __init__(self):
+        self.requests = []
+
+    def get_server_uri(self):
+        return 'https://example.org/ermrest/catalog/1@2PM-DGYP-56Z4'
+
+    def get(self, path, *args, **kwargs):
+        self.requests.append(path)
+        ids = path[len('/entity/Zebrafish:Image/'):].split(';')
+        return Response([image_row(i[len('ID='):]) for i in ids])
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(synapse_cache, 'query_cache', synapse_cache.QueryCache(str(tmp_path)))
+    return Snapshot()
+
+
+def test_image_rows_are_fetched_in_bulk_and_cached(catalog):
+    rows = synapse_utils.get_image_rows(catalog, ['A', 'B', 'C', 'A'], chunk=2)
+    assert sorted(rows) == ['A', 'B', 'C']
+    assert len(catalog.requests) == 2
+    assert synapse_utils.get_image_rows(catalog, ['A', 'B', 'C']) == rows
+    assert len(catalog.requests) == 2
+
+
+def test_alignment_is_answered_from_prefetched_rows(catalog):
+    rows = synapse_utils.get_image_rows(catalog, ['A', 'B'])
+    image_catalog = synapse_utils.ImageRowCatalog(catalog, rows)
+    requests = list(catalog.requests)
+    for image_id in ['A', 'B']:
+        alignment = ImageGrossAlignment.from_image_id(image_catalog, image_id)
+        assert alignment.M_canonical is not None
+    assert image_catalog.misses == []
+    assert catalog.requests == requests
+
+
+def test_requests_that_are_not_prefetched_are_reported(catalog):
+    image_catalog = synapse_utils.ImageRowCatalog(catalog, {})
+    ImageGrossAlignment.from_image_id(image_catalog, 'A')
+    assert len(image_catalog.misses) == 1
+    assert catalog.requests == image_catalog.misses
@@ -0,0 +1,68 @@
+import pytest
+from deriva.core import ErmrestCatalog
+
+import synapse_utils
+
+
+class Response(object):
+    def __init__(self, snaptime):
+        self.snaptime = snaptime
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'id': '1', 'snaptime': self.snaptime}
+
+
+class Catalog(ErmrestCatalog):
+    """
+    An ErmrestCatalog whose latest snapshot is taken from a list, counting the bindings that are made.
+    """
+    snaptimes = []
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        Catalog.instances += 1
+
+    def get(self, path, *args, **kwargs):
+        assert path == '/'
+        return Response(self.snaptimes.pop(0))
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    monkeypatch.setattr(synapse_utils, 'ErmrestCatalog', Catalog)
+    monkeypatch.setattr(synapse_utils, 'get_credential', lambda host: None)
+    synapse_utils.reset_clients()
+    Catalog.instances = 0
+    yield Catalog
+    synapse_utils.reset_clients()
+
+
+def test_latest_snapshot_uses_the_shared_client(catalog):
+    catalog.snaptimes = ['2PM-0001', '2PM-0001', '2PM-0002']
+    first = synapse_utils.get_latest_snapshot('example.org')
+    assert first.snaptime == '2PM-0001'
+    assert synapse_utils.get_latest_snapshot('example.org') is first
+    assert synapse_utils.get_latest_snapshot('example.org').snaptime == '2PM-0002'
+    assert catalog.instances == 1
+
+
+def test_only_the_most_recent_snapshot_clients_are_kept(catalog, monkeypatch):
+    monkeypatch.setattr(synapse_utils, 'snapshot_clients', 2)
+    snaptimes = ['2PM-000{0}'.format(i) for i in range(5)]
+    catalog.snaptimes = list(snaptimes)
+    snapshots = [synapse_utils.get_latest_snapshot('example.org') for i in range(5)]
+    assert [s.snaptime for s in snapshots] == snaptimes
+    kept = [k for k in synapse_utils._clients if k[0] == 'snapshot']
+    assert kept == [('snapshot', 'example.org', '2PM-0003'), ('snapshot', 'example.org', '2PM-0004')]
+    # The catalog client is not counted against the snapshots.
+    assert ('catalog', 'example.org', None) in synapse_utils._clients
+
+    # Using a snapshot keeps it, and a dropped snapshot gets a new client.
+    assert synapse_utils.get_catalog('2PM-0003', 'example.org') is snapshots[3]
+    assert synapse_utils.get_catalog('2PM-0001', 'example.org') is not snapshots[1]
+    kept = [k for k in synapse_utils._clients if k[0] == 'snapshot']
+    assert kept == [('snapshot', 'example.org', '2PM-0003'), ('snapshot', 'example.org', '2PM-0001')]
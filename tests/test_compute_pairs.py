@@ -0,0 +1,43 @@
+import pytest
+
+import synapse_fetch
+import synapse_utils
+from deriva.core import DerivaPathError
+
+
+@pytest.fixture
+def retrieve(monkeypatch):
+    """
+    Replace retrieve_study with one that fails with the given errors before it succeeds.
+    """
+    calls = []
+
+    def setup(*errors):
+        def retrieve_study(s):
+            calls.append(s['Study'])
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return 'data'
+        monkeypatch.setattr(synapse_utils, 'retrieve_study', retrieve_study)
+        return calls
+
+    monkeypatch.setattr(synapse_fetch, 'retry_delay', 0)
+    monkeypatch.setattr(synapse_utils, 'pair_study', lambda s, study, *args: dict(s, Data=study))
+    return setup
+
+
+def test_process_study_retries_transient_errors(retrieve):
+    calls = retrieve(ConnectionError('reset'))
+    paired, error = synapse_utils.process_study({'Study': 'S1'}, [4])
+    assert error is None
+    assert paired['Data'] == 'data'
+    assert calls == ['S1', 'S1']
+
+
+def test_process_study_does_not_retry_missing_studies(retrieve):
+    calls = retrieve(DerivaPathError('missing'))
+    s = {'Study': 'S1'}
+    paired, error = synapse_utils.process_study(s, [4])
+    assert isinstance(error, DerivaPathError)
+    assert paired is s
+    assert calls == ['S1']
@@ -0,0 +1,77 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synapse_csv
+
+header = b'Z,Y,X,raw core,raw hollow,DoG core,DoG hollow,override\n'
+metadata = b'saved,parameters,1.0,2.0,3.0,4.0,5.0,\n'
+
+
+def synapse_rows(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.random((n, 7)) * 100
+    return b''.join(('{0},{1},{2},{3},{4},{5},{6},{7}\n'.format(*row, i % 2)).encode('ascii')
+                    for i, row in enumerate(data.round(3)))
+
+
+class Raw(io.RawIOBase):
+    """
+    An unbuffered stream that returns at most a few bytes at a time, like a slow network response.
+    """
+
+    def __init__(self, content, most=7):
+        self.content = io.BytesIO(content)
+        self.most = most
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.content.read(min(len(b), self.most))
+        b[:len(data)] = data
+        return len(data)
+
+
+@pytest.mark.parametrize('saved', [True, False])
+@pytest.mark.parametrize('wrap', [io.BytesIO, Raw])
+def test_read_synapses_leaves_out_the_metadata_row(saved, wrap):
+    rows = synapse_rows()
+    data = synapse_csv.read_synapses(wrap(header + (metadata if saved else b'') + rows))
+    expected = pd.read_csv(io.BytesIO(header + rows))[synapse_csv.synapse_columns]
+    assert list(data.columns) == synapse_csv.synapse_columns
+    assert all(data.dtypes == np.float64)
+    pd.testing.assert_frame_equal(data, expected.astype(np.float64))
+
+
+def test_read_synapses_columns():
+    rows = synapse_rows(10)
+    columns = ['raw hollow', 'X', 'Z']
+    data = synapse_csv.read_synapses(io.BytesIO(header + metadata + rows), columns=columns)
+    assert list(data.columns) == columns
+    everything = synapse_csv.read_synapses(io.BytesIO(header + metadata + rows), columns=None)
+    pd.testing.assert_frame_equal(everything, pd.read_csv(io.BytesIO(header + rows)))
+
+
+def test_read_synapses_copies_the_cleaned_file():
+    rows = synapse_rows()
+    tee = io.BytesIO()
+    synapse_csv.read_synapses(Raw(header + metadata + rows), tee=tee)
+    assert tee.getvalue() == header + rows
+
+
+@pytest.mark.parametrize('saved', [True, False])
+def test_copy_synapses(saved):
+    rows = synapse_rows()
+    dest = io.BytesIO()
+    synapse_csv.copy_synapses(Raw(header + (metadata if saved else b'') + rows), dest)
+    assert dest.getvalue() == header + rows
+
+
+def test_a_file_with_only_a_header():
+    dest = io.BytesIO()
+    synapse_csv.copy_synapses(io.BytesIO(header), dest)
+    assert dest.getvalue() == header
+    assert len(synapse_csv.read_synapses(io.BytesIO(header + metadata))) == 0
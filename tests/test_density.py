@@ -0,0 +1,149 @@
+from math import ceil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synapse_cache
+import synapse_pair
+import synapse_plot_utils as sp
+import synapse_set
+import synapse_store
+import synapse_utils
+
+radii = [2.0, 4.0]
+
+
+def make_studies(n=6, k=1500):
+    studies = []
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        s1 = rng.random((k, 5)) * [40, 60, 80, 100, 100]
+        s2 = s1 + rng.normal(0, 1.5, s1.shape)
+        s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, max(radii))
+        s = {'Study': 'S{0}'.format(i), 'Type': ['learner', 'nonlearner', 'control'][i % 3], 'Aligned': True,
+             'StudyAlignmentPts': None}
+        studies.append(synapse_utils.set_synapses(s, synapse_set.SynapseSet.from_pairing(
+            s1, s2, radii, s1_to_s2, s2_to_s1, distance, transform=np.eye(4))))
+    return studies
+
+
+@pytest.fixture(scope='module')
+def studies():
+    return make_studies()
+
+
+def reference_counts(studies, nbins):
+    """
+    Bin the synapses the way bin_synapses originally did, by cutting each axis with pd.cut and counting.
+    """
+    synapses, smax, smin = sp.aggregate_studies(studies)
+    binsize = min([smax[i] - smin[i] for i in range(3)]) / nbins
+    edges = [[smin[i] + j * binsize for j in range(int(ceil((smax[i] - smin[i]) / binsize)) + 1)] for i in range(3)]
+    counts = {}
+    for t, groups in synapses.items():
+        for g, pts in groups.items():
+            codes = [pd.cut(pts[c], edges[i], labels=False, include_lowest=True).to_numpy()
+                     for i, c in enumerate(['x', 'y', 'z'])]
+            inside = np.all([~np.isnan(c) for c in codes], axis=0)
+            grid = np.zeros([len(e) - 1 for e in edges])
+            np.add.at(grid, tuple(c[inside].astype(int) for c in codes), 1)
+            counts[(t, g)] = grid
+    return counts
+
+
+@pytest.mark.parametrize('nbins', [7, 13])
+def test_bin_synapses_matches_cutting_each_axis(studies, nbins):
+    binned = sp.bin_synapses(studies, nbins=nbins)
+    for (t, g), expected in reference_counts(studies, nbins).items():
+        assert np.array_equal(binned[t][g].transpose('x', 'y', 'z').values, expected), (t, g)
+
+
+def test_sparse_counts_match_dense(studies):
+    dense = sp.bin_synapses(studies, nbins=13)
+    sparse = sp.bin_synapses(studies, nbins=13, sparse=True)
+    for t in dense:
+        for g in sp.aggregate_groups:
+            assert np.array_equal(sp.dense_counts(sparse[t])[g].values, dense[t][g].values)
+
+
+def test_merged_accumulators_match_binning_all_studies(studies):
+    binned = sp.bin_synapses(studies, nbins=13)
+    attrs = binned['all'].attrs
+    parts = [sp.DensityAccumulator(attrs['min'], attrs['max'], attrs['binsize']) for _ in range(2)]
+    parts[0].add_studies(studies[:3])
+    parts[1].add_studies(studies[3:])
+    merged = parts[0].merge(parts[1]).datasets()
+    for t in binned:
+        for g in sp.aggregate_groups:
+            assert np.array_equal(merged[t][g].values, binned[t][g].values)
+
+
+@pytest.mark.parametrize('nbins', [20, 10, 5, 4, 7, 13])
+def test_pyramid_levels_match_binning(studies, nbins):
+    pyramid = sp.DensityPyramid.from_studies(studies, nbins=20)
+    level = pyramid.level(nbins)
+    binned = sp.bin_synapses(studies, nbins=nbins)
+    for t in binned:
+        for g in sp.aggregate_groups:
+            assert np.array_equal(level[t][g].transpose('x', 'y', 'z').values,
+                                  binned[t][g].transpose('x', 'y', 'z').values), (t, g)
+
+
+def test_pyramid_without_studies_only_has_divisors(studies):
+    pyramid = sp.DensityPyramid(sp.bin_synapses(studies, nbins=20), 20)
+    assert pyramid.available() == [1, 2, 4, 5, 10, 20]
+    with pytest.raises(ValueError):
+        pyramid.level(7)
+
+
+def test_pyramid_levels_are_binned_from_the_points_it_keeps(studies, monkeypatch):
+    pyramid = sp.DensityPyramid.from_studies(studies, nbins=20)
+    reads = []
+    aligned_points = sp.aligned_points
+    monkeypatch.setattr(sp, 'aligned_points', lambda *args: reads.append(args) or aligned_points(*args))
+    for nbins in [7, 13, 3]:
+        pyramid.level(nbins)
+    assert reads == []
+    assert sorted(pyramid.points[0]) == sorted(set(s['Type'] for s in studies))
+
+
+def test_pyramid_with_a_cache_only_gathers_the_points_when_it_needs_them(studies):
+    pyramid = sp.DensityPyramid.from_studies(studies, nbins=20, cache=synapse_cache.ResultCache())
+    pyramid.level(10)
+    assert pyramid.points is None
+    binned = pyramid.level(7)
+    assert pyramid.points is not None
+    assert binned['all'].attrs['SourceKey'] == sp.studyset_key(studies, 'bin_synapses', 7, False)
+
+
+def test_cached_binning_is_reused_until_the_studies_change():
+    studies = make_studies(3, 500)
+    cache = synapse_cache.ResultCache()
+    first = sp.bin_synapses(studies, nbins=10, cache=cache)
+    assert len(cache.memory) == 1
+    assert sp.bin_synapses(studies, nbins=10, cache=cache)['all'].identical(first['all'])
+    assert len(cache.memory) == 1
+
+    changed = synapse_utils.recompute_pairs(studies, [1.0, 3.0])
+    sp.bin_synapses(changed, nbins=10, cache=cache)
+    assert len(cache.memory) == 2
+
+
+def test_cached_binning_depends_on_the_radius():
+    studies = make_studies(3, 500)
+    for s in studies:
+        s['Provenence'] = {'PairingKey': 'pairs-' + s['Study']}
+    cache = synapse_cache.ResultCache()
+    sp.bin_synapses(studies, nbins=10, cache=cache)
+
+    # Filtering the radii keeps the provenance, but the synapses are now taken at the larger radius.
+    narrowed = synapse_store.filter_studyset({'Studies': studies}, radii=[4.0])['Studies']
+    binned = sp.bin_synapses(narrowed, nbins=10, cache=cache)
+    expected = sp.bin_synapses(narrowed, nbins=10)
+    assert len(cache.memory) == 2
+    for t in expected:
+        for g in sp.aggregate_groups:
+            assert np.array_equal(binned[t][g].values, expected[t][g].values), (t, g)
+    assert not np.array_equal(binned['all']['PairedBefore'].values,
+                              sp.bin_synapses(studies, nbins=10)['all']['PairedBefore'].values)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+import synapse_fetch
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(synapse_fetch, 'retry_delay', 0)
+
+
+class Calls(object):
+    """
+    A function to map that records how many calls are running at once and fails the first tries of some items.
+    """
+
+    def __init__(self, failures=None, fatal=()):
+        self.failures = dict(failures or {})
+        self.fatal = fatal
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+        self.started = []
+
+    def __call__(self, item):
+        with self.lock:
+            self.started.append(item)
+            self.running += 1
+            self.most = max(self.most, self.running)
+        try:
+            # Later items finish first, so results have to be put back in order.
+            time.sleep(0.002 * (10 - item % 10))
+            with self.lock:
+                if self.failures.get(item):
+                    self.failures[item] -= 1
+                    raise self.fatal[0]('fatal') if self.fatal else ConnectionError('reset')
+            return item * item
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_results_are_in_order_with_bounded_concurrency():
+    calls = Calls()
+    results = list(synapse_fetch.concurrent_map(calls, range(20), workers=4, progress=False))
+    assert [(item, result, error) for item, result, error in results] == [(i, i * i, None) for i in range(20)]
+    assert 1 < calls.most <= 4
+
+
+def test_only_a_bounded_number_of_results_are_read_ahead():
+    calls = Calls()
+    results = synapse_fetch.concurrent_map(calls, range(20), workers=3, progress=False)
+    assert next(results) == (0, 0, None)
+    time.sleep(0.05)
+    assert len(calls.started) <= 4
+    assert [r for i, r, e in results] == [i * i for i in range(1, 20)]
+
+
+def test_transient_errors_are_retried():
+    calls = Calls(failures={3: 1, 7: 2})
+    results = list(synapse_fetch.concurrent_map(calls, range(10), workers=4, attempts=3, progress=False))
+    assert [r for i, r, e in results] == [i * i for i in range(10)]
+    assert calls.started.count(3) == 2
+    assert calls.started.count(7) == 3
+
+
+def test_errors_are_returned_with_the_item():
+    calls = Calls(failures={2: 5, 5: 1}, fatal=(KeyError,))
+    results = list(synapse_fetch.concurrent_map(calls, range(8), workers=2, attempts=3, fatal=(KeyError,),
+                                                progress=False))
+    errors = {i: e for i, r, e in results if e is not None}
+    assert list(errors) == [2, 5]
+    assert all(isinstance(e, KeyError) for e in errors.values())
+    # Fatal errors are not retried.
+    assert calls.started.count(2) == 1
+    assert [r for i, r, e in results if e is None] == [i * i for i in [0, 1, 3, 4, 6, 7]]
+
+
+def test_concurrent_list_raises_the_first_error():
+    assert synapse_fetch.concurrent_list(Calls(), range(5), workers=2, progress=False) == [0, 1, 4, 9, 16]
+    with pytest.raises(ConnectionError):
+        synapse_fetch.concurrent_list(Calls(failures={1: 5}), range(5), workers=2, attempts=2, progress=False)
@@ -0,0 +1,83 @@
+import numpy as np
+
+import synapse_pair
+import synapse_set
+import synapse_store
+import synapse_utils
+
+
+def make_studies(n=3):
+    return [{'Study': 'S{0}'.format(i), 'Type': 'learner', 'Aligned': False,
+             'BeforeURL': '/hatrac/S{0}/before.csv:v1'.format(i), 'AfterURL': '/hatrac/S{0}/after.csv:v1'.format(i),
+             'BeforeImageID': 'I{0}'.format(i), 'AlignP0': None, 'AlignP1': None, 'AlignP2': None}
+            for i in range(n)]
+
+
+class Pairing(object):
+    """
+    Stands in for paired_studies, pairing random synapses with the native engine and recording what was paired.
+    """
+
+    def __init__(self, radii):
+        self.radii = radii
+        self.paired = []
+
+    def __call__(self, studylist):
+        for s in studylist:
+            self.paired.append(s['Study'])
+            rng = np.random.default_rng(int(s['Study'][1:]))
+            s1 = rng.random((200, 5)) * 20
+            s2 = s1 + rng.normal(0, 1, s1.shape)
+            s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, max(self.radii))
+            synapses = synapse_set.SynapseSet.from_pairing(s1, s2, self.radii, s1_to_s2, s2_to_s1, distance)
+            yield s, synapse_utils.set_synapses(s, synapses), None
+
+
+def memoized(studylist, radii, **kwargs):
+    pairing = Pairing(radii)
+    parameters = synapse_utils.pairing_parameters(radii, engine='native')
+    return synapse_utils.memoized_pairs(studylist, pairing, parameters, **kwargs), pairing
+
+
+def test_previous_studies_are_reused():
+    previous, _ = memoized(make_studies(), [2, 4])
+    studies, pairing = memoized(make_studies(), [2, 4], previous={'Studies': previous})
+    assert pairing.paired == []
+    assert len(studies[0]['PairedBefore'][2]['Data']) == len(previous[0]['PairedBefore'][2]['Data'])
+
+
+def test_filtered_previous_studies_are_paired_again():
+    previous, _ = memoized(make_studies(), [2, 4])
+    narrowed = synapse_store.filter_studyset({'Studies': previous}, radii=[4])
+    studies, pairing = memoized(make_studies(), [2, 4], previous=narrowed)
+    assert pairing.paired == ['S0', 'S1', 'S2']
+    assert len(studies[0]['PairedBefore'][2]['Data']) == len(previous[0]['PairedBefore'][2]['Data'])
+
+
+def test_changed_parameters_are_paired_again():
+    previous, _ = memoized(make_studies(), [2, 4])
+    studies, pairing = memoized(make_studies(), [2, 5], previous={'Studies': previous})
+    assert pairing.paired == ['S0', 'S1', 'S2']
+
+
+def test_checkpoint_is_resumed(tmp_path):
+    first, pairing = memoized(make_studies(), [2, 4], checkpoint=str(tmp_path))
+    assert pairing.paired == ['S0', 'S1', 'S2']
+
+    studies, pairing = memoized(make_studies(), [2, 4], checkpoint=str(tmp_path), resume=True)
+    assert pairing.paired == []
+    assert [s['Study'] for s in studies] == ['S0', 'S1', 'S2']
+    for s, t in zip(studies, first):
+        assert np.array_equal(s['PairedBefore'][4]['Data'].to_numpy(), t['PairedBefore'][4]['Data'].to_numpy())
+
+
+def test_checkpoint_with_other_parameters_is_not_resumed(tmp_path):
+    memoized(make_studies(), [2, 4], checkpoint=str(tmp_path))
+    _, pairing = memoized(make_studies(), [2, 5], checkpoint=str(tmp_path), resume=True)
+    assert pairing.paired == ['S0', 'S1', 'S2']
+
+
+def test_only_missing_studies_are_paired_on_resume(tmp_path):
+    memoized(make_studies(2), [2, 4], checkpoint=str(tmp_path))
+    _, pairing = memoized(make_studies(3), [2, 4], checkpoint=str(tmp_path), resume=True)
+    assert pairing.paired == ['S2']
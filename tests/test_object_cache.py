@@ -0,0 +1,155 @@
+import base64
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from deriva.core import HatracStore
+from deriva.core.hatrac_store import HatracHashMismatch
+
+import synapse_cache
+
+
+def md5(content):
+    return base64.b64encode(hashlib.md5(content).digest()).decode('ascii')
+
+
+class ObjectServer(object):
+    """
+    A local HTTP server for a set of hatrac objects that records which objects are asked for.
+    """
+
+    def __init__(self, objects):
+        """
+        :param objects: map from path to content, or to (content, Content-MD5) to send a particular MD5.
+        """
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                if self.path not in objects:
+                    self.send_error(404)
+                    return
+                content = objects[self.path]
+                content, content_md5 = content if isinstance(content, tuple) else (content, md5(content))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('Content-MD5', content_md5)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        self.store = HatracStore('http', '127.0.0.1:{0}'.format(self.httpd.server_address[1]))
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+content = os.urandom(300000)
+objects = {
+    '/hatrac/a.csv:v1': content,
+    '/hatrac/b.csv:v1': content[::-1],
+    '/hatrac/c.csv:v1': content[:100000],
+    '/hatrac/latest.csv': content,
+    '/hatrac/corrupt.csv:v1': (content, md5(b'something else')),
+}
+
+
+@pytest.fixture
+def server():
+    server = ObjectServer(objects)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return synapse_cache.ObjectCache(str(tmp_path))
+
+
+def entries(cache):
+    return sorted(e.name for e in os.scandir(cache.path))
+
+
+def test_versioned_objects_are_only_downloaded_once(server, cache, tmp_path):
+    fname = cache.get_obj(server.store, '/hatrac/a.csv:v1', destfilename=str(tmp_path / 'a.csv'))
+    assert fname == cache.lookup('/hatrac/a.csv:v1')
+    assert cache.get_obj(server.store, '/hatrac/a.csv:v1', destfilename=str(tmp_path / 'a.csv')) == fname
+    with open(fname, 'rb') as fo:
+        assert fo.read() == content
+    assert server.requests == ['/hatrac/a.csv:v1']
+
+
+def test_unversioned_objects_are_not_cached(server, cache, tmp_path):
+    dest = str(tmp_path / 'latest.csv')
+    for i in range(2):
+        assert cache.get_obj(server.store, '/hatrac/latest.csv', destfilename=dest) == dest
+    assert server.requests == ['/hatrac/latest.csv'] * 2
+    assert entries(cache) == []
+
+
+def test_objects_with_a_known_md5_are_checked(server, cache, tmp_path):
+    dest = str(tmp_path / 'a.csv')
+    assert cache.get_obj(server.store, '/hatrac/latest.csv', destfilename=dest, md5=md5(content)) == \
+        cache.lookup('/hatrac/anything', md5(content))
+    with pytest.raises(HatracHashMismatch):
+        cache.get_obj(server.store, '/hatrac/b.csv:v1', destfilename=dest, md5=md5(b'not b'))
+    assert cache.lookup('/hatrac/b.csv:v1', md5(b'not b')) is None
+    assert entries(cache) == [cache.key('', md5(content))]
+
+
+def test_least_recently_used_entries_are_evicted(server, tmp_path):
+    cache = synapse_cache.ObjectCache(str(tmp_path), max_bytes=2 * len(content))
+    a = cache.get_obj(server.store, '/hatrac/a.csv:v1')
+    b = cache.get_obj(server.store, '/hatrac/b.csv:v1')
+    os.utime(a, (0, 0))
+    os.utime(b, (1, 1))
+    # Looking up an entry marks it as recently used, so b is the one to go.
+    assert cache.lookup('/hatrac/a.csv:v1') == a
+    c = cache.get_obj(server.store, '/hatrac/c.csv:v1')
+    assert cache.lookup('/hatrac/b.csv:v1') is None
+    assert entries(cache) == sorted(os.path.basename(f) for f in [a, c])
+
+
+def test_a_stream_that_is_read_to_the_end_is_cached(server, cache):
+    with cache.open_obj(server.store, '/hatrac/a.csv:v1') as fo:
+        assert fo.read(1000) == content[:1000]
+        assert fo.read() == content[1000:]
+    fname = cache.lookup('/hatrac/a.csv:v1')
+    with open(fname, 'rb') as fo:
+        assert fo.read() == content
+
+    with cache.open_obj(server.store, '/hatrac/a.csv:v1') as fo:
+        assert fo.read() == content
+    assert server.requests == ['/hatrac/a.csv:v1']
+
+
+def test_a_stream_that_is_closed_part_way_leaves_nothing(server, cache):
+    with cache.open_obj(server.store, '/hatrac/a.csv:v1') as fo:
+        assert fo.read(1000) == content[:1000]
+    assert cache.lookup('/hatrac/a.csv:v1') is None
+    assert entries(cache) == []
+
+
+def test_unversioned_objects_are_streamed_without_caching(server, cache):
+    with cache.open_obj(server.store, '/hatrac/latest.csv') as fo:
+        assert fo.read() == content
+    assert entries(cache) == []
+
+
+@pytest.mark.parametrize('url,expected', [('/hatrac/corrupt.csv:v1', None), ('/hatrac/a.csv:v1', md5(b'not a'))])
+def test_a_stream_with_the_wrong_md5_is_not_cached(server, cache, url, expected):
+    with pytest.raises(HatracHashMismatch):
+        with cache.open_obj(server.store, url, md5=expected) as fo:
+            fo.read()
+    assert cache.lookup(url, expected) is None
+    assert entries(cache) == []
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import synapse_pair
+import synapse_set
+
+radii = [1.0, 2.5, 4.0]
+
+
+def random_synapses(n=800, seed=0):
+    rng = np.random.default_rng(seed)
+    s1 = rng.random((n, 5)) * [30, 30, 30, 100, 100]
+    s2 = s1[rng.permutation(n)] + rng.normal(0, 1.5, (n, 5)) * [1, 1, 1, 5, 5]
+    return s1, s2
+
+
+def brute_force_pairs(s1, s2, radius, ratio=None):
+    """
+    Mutual nearest neighbours within radius, found from the full distance matrix.
+    """
+    v1, v2 = synapse_pair.pairing_space(s1, ratio), synapse_pair.pairing_space(s2, ratio)
+    d = np.linalg.norm(v1[:, None, :] - v2[None, :, :], axis=2)
+    nearest2, nearest1 = d.argmin(axis=1), d.argmin(axis=0)
+    s1_to_s2 = np.full(len(s1), -1)
+    for i, j in enumerate(nearest2):
+        if nearest1[j] == i and d[i, j] < radius:
+            s1_to_s2[i] = j
+    return s1_to_s2
+
+
+@pytest.mark.parametrize('ratio', [None, 0.05])
+def test_native_pairing_is_mutual_nearest_neighbours(ratio):
+    s1, s2 = random_synapses(300)
+    s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, 4.0, ratio)
+    assert np.array_equal(s1_to_s2, brute_force_pairs(s1, s2, 4.0, ratio))
+    paired = s1_to_s2 >= 0
+    assert np.array_equal(s2_to_s1[s1_to_s2[paired]], np.nonzero(paired)[0])
+
+
+@pytest.mark.parametrize('ratio', [None, 0.05])
+def test_thresholded_pairs_match_pairing_at_each_radius(ratio):
+    s1, s2 = random_synapses()
+    s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, max(radii), ratio)
+    synapses = synapse_set.SynapseSet.from_pairing(s1, s2, radii, s1_to_s2, s2_to_s1, distance)
+    for r in radii:
+        expected, expected_after, _ = synapse_pair.pair_synapses(s1, s2, r, ratio)
+        assert np.array_equal(synapses.paired('Before', r), expected >= 0)
+        assert np.array_equal(synapses.paired('After', r), expected_after >= 0)
+        assert np.array_equal(synapses.indices('PairedAfter', r)[1], expected[expected >= 0])
+    rate = synapses.pairing_rate(radii)
+    assert list(rate['Pairs']) == [np.count_nonzero(synapse_pair.pair_synapses(s1, s2, r, ratio)[0] >= 0)
+                                   for r in radii]
+
+
+def test_radius_is_exclusive():
+    s1 = np.array([[0., 0, 0, 1, 1]])
+    s2 = np.array([[0., 0, 2, 1, 1]])
+    s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, 3.0)
+    synapses = synapse_set.SynapseSet.from_pairing(s1, s2, [2.0, 3.0], s1_to_s2, s2_to_s1, distance)
+    assert synapse_pair.pair_synapses(s1, s2, 2.0)[0][0] == -1
+    assert not synapses.paired('Before', 2.0)[0]
+    assert synapses.paired('Before', 3.0)[0]
+    assert list(synapses.summary()['Count']) == [0, 1, 1, 0, 0, 1, 1, 0]
+
+
+def test_pairing_maps_are_kept_for_each_radius():
+    # A greedy pairing can pair a synapse at a smaller radius that is unpaired, or paired differently, at the largest.
+    s1 = np.array([[0., 0, 0, 1, 1], [0, 0, 3, 1, 1], [0, 0, 9, 1, 1]])
+    s2 = np.array([[0., 0, 1, 1, 1], [0, 0, 2.5, 1, 1]])
+    s1_to_s2 = np.array([[-1, 1, -1], [0, -1, -1]])
+    s2_to_s1 = np.array([[-1, 1], [0, -1]])
+    synapses = synapse_set.SynapseSet.from_pairing_maps(s1, s2, [1.5, 3.0], s1_to_s2, s2_to_s1)
+    assert not synapses.thresholded()
+    assert list(synapses.indices('PairedBefore', 1.5)[1]) == [1]
+    assert list(synapses.indices('PairedAfter', 1.5)[1]) == [1]
+    assert list(synapses.indices('PairedBefore', 3.0)[1]) == [0]
+    assert list(synapses.indices('UnpairedAfter', 3.0)[1]) == [1]
+    assert list(synapses.pairing_rate([1.5, 3.0])['Pairs']) == [1, 1]
+    with pytest.raises(ValueError):
+        synapses.pairing_rate([2.0])
+
+    summary = synapses.summary().set_index(['DataType', 'Radius'])
+    assert summary.loc[('PairedBefore', 1.5), 'Count'] == 1
+    assert summary.loc[('PairedBefore', 1.5), 'MaxX'] == 3
+    assert summary.loc[('PairedBefore', 3.0), 'MaxX'] == 0
+    assert summary.loc[('UnpairedBefore', 3.0), 'Count'] == 2
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from synapse_pipeline import Stage, run_pipeline
+
+
+class Counter(object):
+    """
+    Records the items a stage has been given and how many of its calls are running at once.
+    """
+
+    def __init__(self, func, delay=0.0):
+        self.func = func
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.seen = []
+        self.running = 0
+        self.most = 0
+
+    def __call__(self, value):
+        with self.lock:
+            self.seen.append(value)
+            self.running += 1
+            self.most = max(self.most, self.running)
+        try:
+            time.sleep(self.delay(value) if callable(self.delay) else self.delay)
+            return self.func(value)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_results_pass_through_each_stage_in_order():
+    # Earlier items take longer in the second stage, so they finish out of order.
+    stages = [Stage('add', lambda x: x + 1, workers=2),
+              Stage('square', Counter(lambda x: x * x, delay=lambda x: 0.002 * (10 - x % 10)), workers=3)]
+    results = list(run_pipeline(range(20), stages))
+    assert results == [(i, (i + 1) ** 2, None) for i in range(20)]
+    assert 1 < stages[1].func.most <= 3
+
+
+def test_a_failed_item_skips_the_later_stages():
+    def check(x):
+        if x % 3 == 0:
+            raise ValueError(x)
+        return x
+
+    last = Counter(lambda x: -x)
+    results = list(run_pipeline(range(9), [Stage('check', check, workers=2), Stage('negate', last)]))
+    assert [r for i, r, e in results if e is None] == [-i for i in range(9) if i % 3]
+    errors = {i: e for i, r, e in results if e is not None}
+    assert list(errors) == [0, 3, 6]
+    assert all(isinstance(e, ValueError) and r is None for i, r, e in results if e is not None)
+    assert sorted(last.seen) == [i for i in range(9) if i % 3]
+
+
+def test_a_slow_stage_holds_back_the_earlier_ones():
+    first = Counter(lambda x: x)
+    slow = Counter(lambda x: x, delay=0.01)
+    stages = [Stage('first', first, workers=2), Stage('slow', slow)]
+    results = run_pipeline(range(50), stages, queue_size=1)
+    assert next(results) == (0, 0, None)
+    time.sleep(0.1)
+    # Only the items that fit in the threads and queues, and the one that was consumed, have been started.
+    assert len(first.seen) <= sum(s.workers for s in stages) + 1 * (len(stages) + 1) + 1
+    assert len(slow.seen) < 20
+    assert [r for i, r, e in results] == list(range(1, 50))
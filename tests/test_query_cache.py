@@ -0,0 +1,83 @@
+import pytest
+
+import synapse_cache
+import synapse_utils
+
+
+def column(name):
+    return {'name': name, 'type': {'typename': 'text'}, 'nullok': True, 'default': None, 'comment': None,
+            'annotations': {}, 'acls': {}, 'acl_bindings': {}}
+
+
+schema = {'acls': {}, 'annotations': {}, 'schemas': {'Synapse': {
+    'schema_name': 'Synapse', 'comment': None, 'annotations': {}, 'tables': {'Collection': {
+        'schema_name': 'Synapse', 'table_name': 'Collection', 'kind': 'table', 'comment': None, 'annotations': {},
+        'acls': {}, 'acl_bindings': {}, 'foreign_keys': [],
+        'column_definitions': [column(c) for c in ['RID', 'URL', 'Description']],
+        'keys': [{'unique_columns': ['RID'], 'names': [['Synapse', 'Collection_RIDkey1']], 'comment': None,
+                  'annotations': {}}]}}}}}
+
+
+class Response(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.rows
+
+
+class Snapshot(object):
+    """
+    Stands in for an ErmrestSnapshot, recording the requests that are made to it.
+    """
+    snaptime = '2PM-DGYP-56Z4'
+    _server_uri = 'https://example.org/ermrest/catalog/1@2PM-DGYP-56Z4'
+
+    def __init__(self):
+        self.requests = []
+
+    def get_server_uri(self):
+        return self._server_uri
+
+    def getCatalogSchema(self):
+        self.requests.append('/schema')
+        return schema
+
+    def get(self, path, *args, **kwargs):
+        self.requests.append(path)
+        return Response([{'RID': 'X', 'URL': '/hatrac/x:1', 'Description': 'x'}])
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(synapse_cache, 'query_cache', synapse_cache.QueryCache(str(tmp_path)))
+    return Snapshot()
+
+
+def test_schema_is_read_once_per_snapshot(catalog):
+    synapse_utils.path_builder(catalog)
+    synapse_utils.path_builder(catalog)
+    assert catalog.requests == ['/schema']
+
+
+def test_queries_are_cached_by_uri(catalog, tmp_path):
+    collection = synapse_utils.path_builder(catalog).Synapse.tables['Collection']
+    query = collection.filter(collection.RID == 'X').entities()
+    assert query.uri.startswith(catalog.get_server_uri())
+
+    rows = synapse_utils.cached_query(catalog, query)
+    assert synapse_utils.cached_query(catalog, collection.filter(collection.RID == 'X').entities()) == rows
+    assert len(catalog.requests) == 2
+
+    # Changing the projection changes the URI, so the query is run again.
+    synapse_utils.cached_query(catalog, collection.filter(collection.RID == 'X').attributes(collection.URL))
+    assert len(catalog.requests) == 3
+
+    # Results are kept on disk, so a new session doesn't run the query or read the schema again.
+    synapse_cache.query_cache = synapse_cache.QueryCache(str(tmp_path))
+    collection = synapse_utils.path_builder(catalog).Synapse.tables['Collection']
+    assert synapse_utils.cached_query(catalog, collection.filter(collection.RID == 'X').entities()) == rows
+    assert len(catalog.requests) == 3
@@ -0,0 +1,185 @@
+import os
+import pickle
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+from deriva.core import HatracStore
+
+import synapse_pair
+import synapse_plot_utils as sp
+import synapse_set
+import synapse_store
+import synapse_utils
+
+radii = [2.0, 4.0]
+datatypes = ['PairedBefore', 'PairedAfter', 'UnpairedBefore', 'UnpairedAfter', 'AlignedPairedBefore']
+
+
+def make_studyset(n=4, k=400):
+    rng = np.random.default_rng(1)
+    studies = []
+    for i in range(n):
+        s1 = rng.random((k, 5)) * 30
+        s2 = s1 + rng.normal(0, 1, s1.shape)
+        s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, max(radii))
+        s = {'Study': 'S{0}'.format(i), 'Type': ['learner', 'nonlearner'][i % 2], 'Aligned': True,
+             'StudyAlignmentPts': None}
+        studies.append(synapse_utils.set_synapses(s, synapse_set.SynapseSet.from_pairing(
+            s1, s2, radii, s1_to_s2, s2_to_s1, distance, transform=np.eye(4))))
+
+    # A study from before SynapseSet, with a DataFrame for each datatype and radius.
+    legacy = {'Study': 'L0', 'Type': 'learner', 'Aligned': False}
+    for d in datatypes[:4]:
+        legacy[d] = {r: {'Data': pd.DataFrame(rng.random((50, 5)), columns=synapse_set.point_columns),
+                         'DataType': d, 'Radius': r} for r in radii}
+    studies.append(legacy)
+    return {'StudyID': 'X@1', 'Studies': studies, 'Summary': synapse_utils.summarize_studies(studies)}
+
+
+def frames(sset):
+    return {(s['Study'], d, r): s[d][r]['Data'] for s in sset['Studies'] for d in datatypes if d in s for r in s[d]}
+
+
+def assert_same_frames(restored, original):
+    expected = frames(original)
+    actual = frames(restored)
+    assert sorted(actual, key=str) == sorted(expected, key=str)
+    for k, v in expected.items():
+        pd.testing.assert_frame_equal(actual[k], v)
+
+
+@pytest.fixture(scope='module')
+def studyset():
+    return make_studyset()
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+def test_columnar_round_trip(studyset, tmp_path, lazy):
+    synapse_store.dump_columnar(studyset, str(tmp_path / 'sset'))
+    restored = synapse_store.restore_columnar(str(tmp_path / 'sset'), lazy=lazy)
+    assert_same_frames(restored, studyset)
+    pd.testing.assert_frame_equal(restored['Summary'], studyset['Summary'])
+
+
+def test_filtering_a_lazy_studyset_does_not_load_it(studyset, tmp_path):
+    synapse_store.dump_columnar(studyset, str(tmp_path / 'sset'))
+    restored = synapse_store.restore_columnar(str(tmp_path / 'sset'), lazy=True)
+    legacy = restored['Studies'][-1]
+    arrays = restored['Studies'][0]['Synapses'].arrays
+
+    narrowed = synapse_store.filter_studyset(restored, radii=[4.0])
+    assert not any(legacy[d][r].loaded() for d in datatypes[:4] for r in radii)
+    assert dict.__len__(arrays) == 0
+    assert list(narrowed['Studies'][-1]['PairedBefore']) == [4.0]
+    assert list(narrowed['Studies'][0]['PairedBefore']) == [4.0]
+
+    # A filtered lazy studyset can be written out again, which loads what is left.
+    synapse_store.dump_columnar(narrowed, str(tmp_path / 'narrowed'))
+    assert_same_frames(synapse_store.restore_columnar(str(tmp_path / 'narrowed')),
+                       synapse_store.filter_studyset(studyset, radii=[4.0]))
+    assert not legacy['PairedBefore'][2.0].loaded()
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+def test_archive_round_trip(studyset, tmp_path, lazy):
+    fname = str(tmp_path / 'studies.sset')
+    synapse_store.dump_archive(studyset, fname)
+    assert synapse_store.is_archive(fname)
+    restored = synapse_store.read_archive(synapse_store.file_range_reader(fname), lazy=lazy)
+    assert_same_frames(restored, studyset)
+    pd.testing.assert_frame_equal(restored['Summary'], studyset['Summary'])
+
+
+class RangeServer(object):
+    """
+    A local HTTP server for a single file that honours Range headers and records the ranges that are asked for.
+    """
+
+    def __init__(self, fname, path):
+        self.ranges = []
+        with open(fname, 'rb') as fo:
+            content = fo.read()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != path:
+                    self.send_error(404)
+                    return
+                m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+                start, end = (int(m.group(1)), int(m.group(2))) if m else (0, len(content) - 1)
+                server.ranges.append((start, end))
+                body = content[start:end + 1]
+                self.send_response(206 if m else 200)
+                if m:
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(content)))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:{0}'.format(self.httpd.server_address[1])
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def archive_server(studyset, tmp_path):
+    fname = str(tmp_path / 'studies.sset')
+    synapse_store.dump_archive(studyset, fname)
+    server = RangeServer(fname, '/hatrac/studies.sset')
+    yield server, fname
+    server.close()
+
+
+@pytest.mark.parametrize('selection', [{'studies': ['S1', 'L0']}, {'types': ['nonlearner']}, {'radii': [4.0]},
+                                       {'studies': ['S0', 'S1', 'S2'], 'types': ['learner'], 'radii': [2.0]}])
+def test_archive_range_requests_only_read_the_selection(archive_server, selection):
+    server, fname = archive_server
+    reader = synapse_store.hatrac_range_reader(HatracStore('http', server.host), '/hatrac/studies.sset')
+    restored = synapse_store.read_archive(reader, **selection)
+
+    expected = synapse_store.filter_studyset(synapse_store.read_archive(synapse_store.file_range_reader(fname)),
+                                             **selection)
+    assert_same_frames(restored, expected)
+    pd.testing.assert_frame_equal(restored['Summary'], expected['Summary'])
+
+    # Only the prefix, the index and the blocks of the selected studies and radii are transferred.
+    read_range = synapse_store.file_range_reader(fname)
+    length = synapse_store.archive_prefix.unpack(read_range(0, synapse_store.archive_prefix.size))[1]
+    index = pickle.loads(read_range(synapse_store.archive_prefix.size, length))
+    ids = [s['Study'] for s in index['Studyset']['Studies']]
+    selected = [b['Length'] for b in index['Blocks'] if ids[b['Study']] in [s['Study'] for s in expected['Studies']]
+                and (selection.get('radii') is None or b['Radius'] is None or b['Radius'] in selection['radii'])]
+    transferred = sum(end - start + 1 for start, end in server.ranges)
+    assert transferred == synapse_store.archive_prefix.size + length + sum(selected)
+    assert transferred < os.path.getsize(fname)
+
+
+def test_density_round_trip(tmp_path):
+    studyset = make_studyset(4, 300)
+    studies = studyset['Studies'][:-1]
+    for sparse in [False, True]:
+        binned = sp.bin_synapses(studies, nbins=8, sparse=sparse)
+        dirname = str(tmp_path / 'density-{0}'.format(sparse))
+        synapse_store.dump_density(binned, dirname)
+        restored = synapse_store.restore_density(dirname)
+        assert sorted(restored) == sorted(binned)
+        for t in binned:
+            assert restored[t].identical(binned[t])
+        assert isinstance(restored['all']['All'].data, np.memmap)
+    assert list(synapse_store.restore_density(dirname, types=['learner'])) == ['learner']
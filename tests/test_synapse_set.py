@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+import synapse_pair
+import synapse_set
+
+
+def make_synapses(k=300, seed=0):
+    rng = np.random.default_rng(seed)
+    s1 = rng.random((k, 5)) * 30
+    s2 = s1 + rng.normal(0, 1, s1.shape)
+    s1_to_s2, s2_to_s1, distance = synapse_pair.pair_synapses(s1, s2, 4.0)
+    transform = np.eye(4)
+    transform[0:3, 0:3] = [[0, 1, 0], [-1, 0, 0], [0, 0, 2]]
+    transform[3, 0:3] = [5, -3, 10]
+    return synapse_set.SynapseSet.from_pairing(s1, s2, [2.0, 4.0], s1_to_s2, s2_to_s1, distance, transform=transform)
+
+
+def test_transform_points_uses_homogeneous_row_vectors():
+    rng = np.random.default_rng(1)
+    M = rng.random((4, 4))
+    pts = rng.random((50, 3)) * 100
+    expected = np.array([np.append(p, 1.0).astype(np.float32) @ M for p in pts])[:, 0:3]
+    assert np.allclose(synapse_set.transform_points(M, pts), expected)
+
+
+def test_aligned_points_are_transformed_once():
+    synapses = make_synapses()
+    before = synapses.aligned('Before')
+    assert synapses.aligned('Before') is before
+
+    pts = synapses.arrays[('Before', None)]
+    xyz = pts[:, [2, 1, 0]] @ synapses.transform[0:3, 0:3] + synapses.transform[3, 0:3]
+    assert np.allclose(before[:, 0:3], xyz, atol=1e-4)
+    assert np.array_equal(before[:, 3], pts[:, 3])
+
+    for r in synapses.radii:
+        name, idx = synapses.indices('PairedBefore', r)
+        frame = synapses.frame('AlignedPairedBefore', r)
+        assert list(frame.columns) == ['x', 'y', 'z', 'core']
+        assert np.array_equal(frame.to_numpy(), before[idx])
+
+
+def test_aligned_centroid():
+    synapses = make_synapses()
+    centroid = synapses.frame('AlignedUnpairedAfterCentroid', 2.0)
+    points = synapses.frame('AlignedUnpairedAfter', 2.0)
+    pd.testing.assert_frame_equal(centroid, pd.DataFrame([points[['x', 'y', 'z']].mean().to_numpy()],
+                                                         columns=['x', 'y', 'z']))